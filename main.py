@@ -1,21 +1,3119 @@
 import sys
 import os
-import cv2
+import argparse
+import glob
+import importlib.util
 import json
+import math
 import numpy as np
-import face_recognition
 import shutil  # для видалення теки при видаленні обличчя
+import sqlite3
+import hashlib
+import heapq
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
+from functools import partial
 
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                                QHBoxLayout, QLabel, QPushButton, QListWidget,
                                QFrame, QScrollArea, QDialog, QLineEdit, QTextEdit,
-                               QDialogButtonBox, QFileDialog, QMessageBox, QGridLayout, QStyle)
-from PySide6.QtCore import Qt, QTimer, QSize, QEventLoop, QRect
-from PySide6.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QFont, QShortcut, QKeySequence, QKeyEvent, QIcon, QIntValidator
+                               QDialogButtonBox, QFileDialog, QMessageBox, QGridLayout, QStyle,
+                               QProgressBar, QSizePolicy, QListView)
+from PySide6.QtCore import (Qt, QTimer, QSize, QEventLoop, QRect, QObject, QThread, Signal, QRegularExpression,
+                            QAbstractListModel, QModelIndex, QSortFilterProxyModel, QBuffer, QIODevice)
+from PySide6.QtGui import (QImage, QPixmap, QPainter, QPen, QColor, QFont, QShortcut, QKeySequence, QKeyEvent, QIcon,
+                           QFontMetrics, QRegularExpressionValidator, QImageReader)
+
+# Момент запуску процесу, від якого рахуються етапи запуску (StartupTimer)
+PROCESS_STARTED = time.perf_counter()
+
+
+def lazy_import(name):
+    """
+    Лінивий імпорт модуля: сам модуль виконується під час першого звернення до його атрибута.
+    face_recognition під час імпорту завантажує моделі dlib (секунди), тож вікно вибору камери
+    з'являється одразу, а моделі вантажаться у фоні (start_face_model_warmup).
+    LazyLoader у Python 3.11 не потокобезпечний: перше звернення має бути з одного потоку.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+cv2 = lazy_import("cv2")
+dlib = lazy_import("dlib")
+face_recognition = lazy_import("face_recognition")
 
 # Допустимі розширення зображень
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
 
+# Дані облич зберігаються в теці face_data; імена файлів усередині неї
+FACE_DATA_FOLDER = "face_data"
+FACE_DATA_FILE_NAME = "face_data.json"
+FACE_DATA_JOURNAL_FILE_NAME = "face_data.journal"
+FACE_DATABASE_FILE_NAME = "faces.db"
+GALLERY_MATRIX_FILE_NAME = "gallery.npy"
+GALLERY_INDEX_FILE_NAME = "gallery_index.json"
+GALLERY_ANN_FILE_NAME = "gallery_ivf.npz"
+ENROLL_MANIFEST_FILE_NAME = "enroll_manifest.json"
+
+# Максимальна відстань між кодуваннями, за якої обличчя вважаються однаковими
+MATCH_TOLERANCE = 0.5
+
+# Починаючи з такого розміру галереї пошук іде через приблизний індекс IVFIndex замість повного перебору
+ANN_MIN_GALLERY_SIZE = 50000
+
+# Повна детекція запускається раз на стільки кадрів, між ними обличчя супроводжуються трекером
+DEFAULT_DETECTION_INTERVAL = 5
+
+# ------------------ РЕЄСТР ОБЛИЧ ------------------
+
+class FaceRecord:
+    """
+    Запис обличчя: збереженого (з файлами в теці face_data) або невідомого, що зараз у кадрі.
+    Фіксований набір полів у __slots__ замість довільного словника – десятки тисяч записів
+    займають у кілька разів менше пам'яті. encoding/pixmap/crop/bbox – лише в пам'яті, у JSON не пишуться.
+    """
+
+    __slots__ = ("id", "name", "description", "image_path", "encoding_path", "encoding", "pixmap", "crop", "bbox")
+
+    def __init__(self, face_id, name, description="", image_path="", encoding_path="", encoding=None):
+        self.id = face_id
+        self.name = name
+        self.description = description
+        self.image_path = image_path
+        self.encoding_path = encoding_path
+        self.encoding = encoding
+        self.pixmap = None
+        self.crop = None
+        self.bbox = None
+
+    def __repr__(self):
+        return f"FaceRecord({self.id!r}, {self.name!r})"
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], data.get("description", ""),
+                   data.get("image_path", ""), data.get("encoding_path", ""))
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "image_path": self.image_path,
+            "encoding_path": self.encoding_path
+        }
+
+
+class FaceRegistry:
+    """
+    Збережені обличчя з доступом за O(1) за id та за ім'ям. Порядок ітерації – порядок додавання.
+    Нові id видаються лічильником, що лише зростає (id видаленого обличчя в сесії не повторюється).
+    """
+
+    def __init__(self, records=()):
+        self._by_id = {}
+        self._by_name = {}
+        self._next_id = 1
+        for record in records:
+            self.add(record)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, face_id):
+        return face_id in self._by_id
+
+    def get(self, face_id):
+        return self._by_id.get(face_id)
+
+    def get_by_name(self, name):
+        return self._by_name.get(name)
+
+    def has_name(self, name):
+        return name in self._by_name
+
+    def allocate_id(self):
+        face_id = self._next_id
+        self._next_id += 1
+        return face_id
+
+    def add(self, record):
+        """Додає запис; якщо id не задано, видає новий."""
+        if record.id is None:
+            record.id = self.allocate_id()
+        self._by_id[record.id] = record
+        self._by_name[record.name] = record
+        self._next_id = max(self._next_id, record.id + 1)
+        return record
+
+    def rename(self, record, new_name):
+        if self._by_name.get(record.name) is record:
+            del self._by_name[record.name]
+        record.name = new_name
+        self._by_name[new_name] = record
+
+    def remove(self, face_id):
+        record = self._by_id.pop(face_id, None)
+        if record is not None and self._by_name.get(record.name) is record:
+            del self._by_name[record.name]
+        return record
+
+
+# ------------------ ГАЛЕРЕЯ КОДУВАНЬ ------------------
+
+def nearest_centroids(data, centroids, chunk_size=8192):
+    """Номер найближчого центроїда для кожного рядка data (частинами, щоб обмежити пам'ять)."""
+    centroid_sq = np.einsum("ij,ij->i", centroids, centroids)
+    assign = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        # |x|^2 однаковий для всіх центроїдів, тож для argmin його можна не додавати
+        assign[start:start + chunk_size] = np.argmin(centroid_sq - 2.0 * (chunk @ centroids.T), axis=1)
+    return assign
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    """Звичайний алгоритм Ллойда; порожні кластери перезасіваються випадковими точками."""
+    rng = np.random.default_rng(seed)
+    centroids = np.array(data[rng.choice(len(data), k, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assign = nearest_centroids(data, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        present = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[present]
+        centroids[present] = np.add.reduceat(data[order], starts, axis=0) / counts[present, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Приблизний пошук найближчого сусіда (inverted file) для дуже великих галерей, лише на NumPy.
+    Кодування розбиваються k-means на nlist кластерів (грубий квантизатор), а запит порівнюється
+    лише з рядками nprobe найближчих до нього кластерів. Індекс зберігає номери рядків матриці
+    FaceGallery і оновлюється інкрементно (без перенавчання) при додаванні, зміні та видаленні облич.
+    """
+
+    def __init__(self, centroids, nprobe=8, trained_size=0):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self.trained_size = trained_size
+        nlist = len(self.centroids)
+        self._lists = [np.empty(16, dtype=np.int32) for _ in range(nlist)]
+        self._sizes = np.zeros(nlist, dtype=np.int64)
+        self._assign = np.empty(0, dtype=np.int32)  # рядок -> кластер
+        self._pos = np.empty(0, dtype=np.int32)     # рядок -> позиція в списку кластера
+
+    @classmethod
+    def train(cls, matrix, nlist=None, nprobe=8, iterations=10, seed=0):
+        """Навчає квантизатор на (підвибірці) matrix та розкладає всі її рядки по кластерах."""
+        count = len(matrix)
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(count)))
+        nlist = min(nlist, count)
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, 64 * nlist)
+        sample = matrix[np.sort(rng.choice(count, sample_size, replace=False))]
+        index = cls(kmeans(np.asarray(sample, dtype=np.float32), nlist, iterations, seed), nprobe, count)
+        index.build(matrix)
+        return index
+
+    def build(self, matrix, assign=None):
+        """Заповнює списки кластерів для всіх рядків matrix (або за готовим розподілом assign)."""
+        if assign is None:
+            assign = nearest_centroids(matrix, self.centroids)
+        nlist = len(self.centroids)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        counts = np.bincount(assign, minlength=nlist)
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        self._lists = [np.array(order[bounds[l]:bounds[l + 1]]) for l in range(nlist)]
+        self._lists = [rows if len(rows) else np.empty(16, dtype=np.int32) for rows in self._lists]
+        self._sizes = counts.astype(np.int64)
+        self._assign = np.asarray(assign, dtype=np.int32).copy()
+        self._pos = np.empty(len(assign), dtype=np.int32)
+        self._pos[order] = np.arange(len(order)) - bounds[assign[order]]
+
+    def _ensure_rows(self, size):
+        if size <= len(self._assign):
+            return
+        capacity = max(size, 2 * len(self._assign), 64)
+        for name in ("_assign", "_pos"):
+            grown = np.empty(capacity, dtype=np.int32)
+            old = getattr(self, name)
+            grown[:len(old)] = old
+            setattr(self, name, grown)
+
+    def add(self, row, vector):
+        cluster = int(nearest_centroids(np.asarray(vector, dtype=np.float32)[None, :], self.centroids)[0])
+        size = self._sizes[cluster]
+        if size == len(self._lists[cluster]):
+            grown = np.empty(2 * size, dtype=np.int32)
+            grown[:size] = self._lists[cluster]
+            self._lists[cluster] = grown
+        self._lists[cluster][size] = row
+        self._sizes[cluster] += 1
+        self._ensure_rows(row + 1)
+        self._assign[row] = cluster
+        self._pos[row] = size
+
+    def _detach(self, row):
+        cluster, pos = self._assign[row], self._pos[row]
+        last = self._sizes[cluster] - 1
+        moved = self._lists[cluster][last]
+        self._lists[cluster][pos] = moved
+        self._pos[moved] = pos
+        self._sizes[cluster] = last
+
+    def update(self, row, vector):
+        self._detach(row)
+        self.add(row, vector)
+
+    def remove(self, row, last_row):
+        """Видаляє row; як і в FaceGallery.remove, на його місце переноситься рядок last_row."""
+        self._detach(row)
+        if row != last_row:
+            cluster, pos = self._assign[last_row], self._pos[last_row]
+            self._lists[cluster][pos] = row
+            self._assign[row] = cluster
+            self._pos[row] = pos
+
+    def search(self, queries, matrix, sq_norms):
+        """
+        Для кожного запиту повертає рядок найближчого знайденого кодування (-1, якщо кандидатів немає)
+        та квадрат відстані до нього.
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_sq = np.einsum("ij,ij->i", self.centroids, self.centroids) - 2.0 * (queries @ self.centroids.T)
+        if nprobe < len(self.centroids):
+            probes = np.argpartition(centroid_sq, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(len(self.centroids)), centroid_sq.shape)
+
+        rows = np.full(len(queries), -1, dtype=np.int64)
+        best_sq = np.full(len(queries), np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self._lists[l][:self._sizes[l]] for l in probes[i]])
+            if not len(candidates):
+                continue
+            sq_dist = sq_norms[candidates] - 2.0 * (matrix[candidates] @ query)
+            best = np.argmin(sq_dist)
+            rows[i] = candidates[best]
+            best_sq[i] = sq_dist[best] + np.dot(query, query)
+        return rows, best_sq
+
+    def state(self, count):
+        """Копія даних для save_state: центроїди та кластери перших count рядків."""
+        return {"centroids": self.centroids.copy(), "assign": self._assign[:count].copy(),
+                "nprobe": self.nprobe, "trained_size": self.trained_size}
+
+    @staticmethod
+    def save_state(path, state, matrix_mtime_ns):
+        """Записує state() поруч з файлом матриці; load прийме його лише для тієї самої матриці."""
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, matrix_mtime_ns=matrix_mtime_ns, **state)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, count, matrix_mtime_ns):
+        """Повертає індекс з файлу або None, якщо він не відповідає збереженій матриці."""
+        try:
+            with np.load(path) as data:
+                if int(data["matrix_mtime_ns"]) != matrix_mtime_ns or len(data["assign"]) != count:
+                    return None
+                index = cls(data["centroids"], int(data["nprobe"]), int(data["trained_size"]))
+                index.build(None, data["assign"])
+                return index
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def synthetic_encodings(count, latent_dim=32, seed=0):
+    """
+    Синтетичні кодування для бенчмарків: справжні кодування облич лежать поблизу многовиду
+    нижчої розмірності, тож генеруємо їх як лінійну проекцію латентних векторів + шум,
+    нормовану до типової для dlib довжини (~1).
+    """
+    rng = np.random.default_rng(seed)
+    projection = rng.normal(size=(latent_dim, FaceGallery.ENCODING_SIZE)).astype(np.float32)
+    encodings = rng.normal(size=(count, latent_dim)).astype(np.float32) @ projection
+    encodings += rng.normal(scale=0.5, size=encodings.shape).astype(np.float32)
+    encodings /= np.linalg.norm(encodings, axis=1, keepdims=True)
+    return encodings
+
+
+def benchmark_ann(sizes=(10000, 100000, 300000), nprobes=(1, 4, 8, 16), query_count=500, noise=0.03):
+    """
+    Порівнює IVFIndex з точним перебором на синтетичній галереї: recall@1 (частка запитів,
+    для яких знайдено той самий найближчий рядок, що й точним пошуком) та запити за секунду.
+    Запити – кодування з галереї зі зсувом (як нове фото тієї самої людини).
+    """
+    results = []
+    print(f"{'size':>8} {'method':>12} {'recall@1':>9} {'qps':>10}")
+    for size in sizes:
+        gallery = FaceGallery(capacity=size)
+        encodings = synthetic_encodings(size)
+        for face_id, encoding in enumerate(encodings):
+            gallery.add(FaceRecord(face_id, str(face_id)), encoding)
+        rng = np.random.default_rng(1)
+        queries = encodings[rng.choice(size, query_count)]
+        queries = queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+
+        start = time.perf_counter()
+        exact_faces, _ = gallery.match(queries)
+        exact_qps = query_count / (time.perf_counter() - start)
+        exact_ids = np.array([face.id for face in exact_faces])
+        results.append({"size": size, "method": "exact", "recall_at_1": 1.0, "qps": exact_qps})
+        print(f"{size:>8} {'exact':>12} {1.0:>9.3f} {exact_qps:>10.0f}")
+
+        start = time.perf_counter()
+        gallery.enable_ann()
+        print(f"{size:>8} {'train':>12} {'':>9} {time.perf_counter() - start:>9.2f}s")
+        for nprobe in nprobes:
+            gallery.ann.nprobe = nprobe
+            start = time.perf_counter()
+            ann_faces, _ = gallery.match(queries)
+            qps = query_count / (time.perf_counter() - start)
+            recall = np.mean(np.array([face.id if face else -1 for face in ann_faces]) == exact_ids)
+            method = f"ivf/{nprobe}"
+            results.append({"size": size, "method": method, "recall_at_1": float(recall), "qps": qps})
+            print(f"{size:>8} {method:>12} {recall:>9.3f} {qps:>10.0f}")
+    return results
+
+class FaceGallery:
+    """
+    Матриця кодувань збережених облич для пакетного пошуку найближчого сусіда.
+    Усі кодування тримаються в одному суцільному масиві float32 (один рядок – одне обличчя),
+    тому порівняння всіх облич кадру з усією галереєю – це одне матричне множення.
+    Рядки адресуються за id обличчя; при видаленні на місце рядка переноситься останній.
+    На диску галерея зберігається одним файлом матриці .npy, який при запуску відкривається
+    через np.memmap, та компактним індексом рядків (див. save/load).
+    """
+
+    ENCODING_SIZE = 128
+
+    def __init__(self, capacity=64):
+        self._matrix = np.empty((capacity, self.ENCODING_SIZE), dtype=np.float32)
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        self._faces = []       # рядок -> FaceRecord
+        self._rows = {}        # id обличчя -> рядок
+        self._file_mtime_ns = None
+        self.ann = None        # необов'язковий IVFIndex для дуже великих галерей
+
+    def __len__(self):
+        return len(self._faces)
+
+    def __contains__(self, face_id):
+        return face_id in self._rows
+
+    def get(self, face_id):
+        row = self._rows.get(face_id)
+        return None if row is None else self._faces[row]
+
+    def encoding(self, face_id):
+        """Повертає копію кодування обличчя (або None, якщо його немає в галереї)."""
+        row = self._rows.get(face_id)
+        return None if row is None else np.array(self._matrix[row])
+
+    def _ensure_capacity(self, size):
+        capacity = self._matrix.shape[0]
+        if size <= capacity:
+            return
+        # Після load/assign порожнього знімка матриця може мати 0 рядків – подвоєння з нуля не росте
+        capacity = max(capacity, 64)
+        while capacity < size:
+            capacity *= 2
+        matrix = np.empty((capacity, self.ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        count = len(self._faces)
+        matrix[:count] = self._matrix[:count]
+        sq_norms[:count] = self._sq_norms[:count]
+        self._matrix = matrix
+        self._sq_norms = sq_norms
+
+    def add(self, face, encoding):
+        """Додає обличчя або оновлює його кодування, якщо id вже є в галереї."""
+        if encoding is None:
+            return
+        row = self._rows.get(face.id)
+        is_new = row is None
+        if is_new:
+            row = len(self._faces)
+            self._ensure_capacity(row + 1)
+            self._faces.append(face)
+            self._rows[face.id] = row
+        else:
+            self._faces[row] = face
+        vector = np.asarray(encoding, dtype=np.float32).reshape(self.ENCODING_SIZE)
+        self._matrix[row] = vector
+        self._sq_norms[row] = np.dot(vector, vector)
+        if self.ann is not None:
+            if is_new:
+                self.ann.add(row, vector)
+            else:
+                self.ann.update(row, vector)
+
+    def remove(self, face_id):
+        row = self._rows.pop(face_id, None)
+        if row is None:
+            return
+        last = len(self._faces) - 1
+        if self.ann is not None:
+            self.ann.remove(row, last)
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._sq_norms[row] = self._sq_norms[last]
+            self._faces[row] = self._faces[last]
+            self._rows[self._faces[row].id] = row
+        self._faces.pop()
+
+    def clear(self):
+        self._faces = []
+        self._rows = {}
+        self.ann = None
+
+    def enable_ann(self, nlist=None, nprobe=8):
+        """Будує IVFIndex над поточними кодуваннями; далі match використовує приблизний пошук."""
+        self.ann = IVFIndex.train(self._matrix[:len(self._faces)], nlist, nprobe)
+
+    def load_ann(self, path):
+        """Відновлює IVFIndex, збережений разом з поточним файлом матриці. Повертає False, якщо не вдалося."""
+        if self._file_mtime_ns is None or not os.path.exists(path):
+            return False
+        self.ann = IVFIndex.load(path, len(self._faces), self._file_mtime_ns)
+        return self.ann is not None
+
+    def snapshot(self):
+        """
+        Копія рядків матриці, їхніх id/імен та стану IVFIndex (None без індексу). Береться під
+        блокуванням галереї, а записується на диск (save) уже без нього, тож розпізнавання не чекає
+        на файлову систему. Усе копіюється разом, тож індекс IVF завжди відповідає рядкам матриці.
+        """
+        if isinstance(self._matrix, np.memmap):
+            # Файл, відображений у пам'ять, не можна замінити (Windows), тож переносимо дані в RAM
+            self._matrix = np.array(self._matrix)
+        count = len(self._faces)
+        return (np.array(self._matrix[:count]), [face.id for face in self._faces],
+                [face.name for face in self._faces], self.ann.state(count) if self.ann is not None else None)
+
+    def save(self, matrix_path, index_path, snapshot=None, ann_path=None):
+        """
+        Записує всі кодування одним файлом матриці .npy та індекс рядків (списки id та імен
+        у порядку рядків) у JSON. Обидва файли замінюються атомарно через тимчасовий файл.
+        Індекс запам'ятовує розмір і час зміни матриці, щоб load міг відкинути неузгоджену пару.
+        Якщо задано ann_path, туди ж записується індекс IVF з того самого знімка.
+        snapshot – результат snapshot(); якщо не задано, знімок береться зараз.
+        """
+        matrix, ids, names, ann_state = snapshot if snapshot is not None else self.snapshot()
+        tmp_path = matrix_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, matrix)
+        os.replace(tmp_path, matrix_path)
+
+        stat = os.stat(matrix_path)
+        self._file_mtime_ns = stat.st_mtime_ns
+        index = {
+            "matrix_size": stat.st_size,
+            "matrix_mtime_ns": stat.st_mtime_ns,
+            "ids": ids,
+            "names": names
+        }
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+        if ann_path and ann_state is not None:
+            IVFIndex.save_state(ann_path, ann_state, stat.st_mtime_ns)
+
+    def load(self, matrix_path, index_path, faces_by_id):
+        """
+        Відкриває збережену матрицю через np.memmap (копіювання при записі, тож зміни не йдуть
+        на диск до save) і прив'язує рядки до записів облич з faces_by_id.
+        Повертає False, якщо файлів немає або вони не узгоджені між собою.
+        """
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            stat = os.stat(matrix_path)
+            if index["matrix_size"] != stat.st_size or index["matrix_mtime_ns"] != stat.st_mtime_ns:
+                return False
+            matrix = np.load(matrix_path, mmap_mode="c")
+        except (OSError, ValueError, KeyError):
+            return False
+        ids = index["ids"]
+        if matrix.dtype != np.float32 or matrix.shape != (len(ids), self.ENCODING_SIZE):
+            return False
+
+        keep = [row for row, face_id in enumerate(ids) if face_id in faces_by_id]
+        if len(keep) != len(ids):
+            # Частину облич видалено з метаданих – такі рядки не беремо
+            matrix = np.array(matrix[keep])
+        self.assign([faces_by_id[ids[row]] for row in keep], matrix)
+        # Рядки, збережені в індексі IVF, відповідають файлу лише якщо нічого не відкинуто
+        self._file_mtime_ns = stat.st_mtime_ns if len(keep) == len(ids) else None
+        return True
+
+    def assign(self, faces, matrix):
+        """Замінює вміст галереї готовою матрицею: faces[i] – обличчя рядка i."""
+        self._matrix = matrix
+        self._sq_norms = np.einsum("ij,ij->i", matrix, matrix).astype(np.float32)
+        self._faces = list(faces)
+        self._rows = {face.id: row for row, face in enumerate(self._faces)}
+
+    def match(self, encodings):
+        """
+        Шукає найближче збережене обличчя для кожного кодування з encodings.
+        Повертає (faces, distances): запис найближчого обличчя (або None для порожньої галереї)
+        та евклідову відстань до нього для кожного вхідного кодування.
+        """
+        if len(encodings) == 0:
+            return [], np.empty(0, dtype=np.float32)
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        count = len(self._faces)
+        if count == 0:
+            return [None] * len(queries), np.full(len(queries), np.inf, dtype=np.float32)
+
+        if self.ann is not None:
+            best_rows, best_sq = self.ann.search(queries, self._matrix[:count], self._sq_norms[:count])
+            distances = np.sqrt(np.maximum(best_sq, 0.0))
+            return [self._faces[row] if row >= 0 else None for row in best_rows], distances
+
+        # |q - g|^2 = |q|^2 + |g|^2 - 2 q·g для всіх пар одразу
+        sq_dist = queries @ self._matrix[:count].T
+        sq_dist *= -2.0
+        sq_dist += self._sq_norms[:count]
+        sq_dist += np.einsum("ij,ij->i", queries, queries)[:, None]
+        best_rows = np.argmin(sq_dist, axis=1)
+        best_sq = sq_dist[np.arange(len(queries)), best_rows]
+        distances = np.sqrt(np.maximum(best_sq, 0.0))
+        return [self._faces[row] for row in best_rows], distances
+
+def load_face_data(folder=FACE_DATA_FOLDER):
+    """
+    Читає метадані облич (face_data.json) та галерею кодувань з теки folder, без GUI.
+    Кодування беруться з консолідованої матриці (один memmap замість файлу на кожне обличчя);
+    обличчя, яких у ній немає, імпортуються зі старої структури <ім'я>/<ім'я>.npy.
+    Поверх знімка застосовується журнал змін, зроблених після останнього стиснення (FaceDataWriter).
+    Якщо в теці є база SQLiteFaceStore (faces.db), усе читається з неї.
+    Повертає (faces, gallery, imported): FaceRegistry, FaceGallery та imported=True, якщо знімок
+    (face_data.json і файл матриці) варто перезаписати.
+    """
+    database_file = os.path.join(folder, FACE_DATABASE_FILE_NAME)
+    if os.path.exists(database_file):
+        faces, gallery = SQLiteFaceStore(database_file).load()
+        return faces, gallery, False
+    return load_face_files(folder)
+
+
+def load_face_files(folder=FACE_DATA_FOLDER):
+    """Файлова частина load_face_data: знімок face_data.json, матриця галереї та журнал."""
+    faces = FaceRegistry()
+    gallery = FaceGallery()
+    imported = False
+    data_file = os.path.join(folder, FACE_DATA_FILE_NAME)
+    journal_file = os.path.join(folder, FACE_DATA_JOURNAL_FILE_NAME)
+    if os.path.exists(data_file):
+        with open(data_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        faces = FaceRegistry(FaceRecord.from_json(entry) for entry in data)
+
+        loaded = gallery.load(os.path.join(folder, GALLERY_MATRIX_FILE_NAME),
+                              os.path.join(folder, GALLERY_INDEX_FILE_NAME), {face.id: face for face in faces})
+        if loaded and len(gallery) >= ANN_MIN_GALLERY_SIZE:
+            # Індекс IVF збережено для рядків саме цієї матриці, тож він вантажиться до журналу:
+            # подальші зміни оновлюють його інкрементно
+            gallery.load_ann(os.path.join(folder, GALLERY_ANN_FILE_NAME))
+        for face in faces:
+            if face.id not in gallery and os.path.exists(face.encoding_path):
+                gallery.add(face, np.load(face.encoding_path))
+                imported = True
+    if replay_face_journal(journal_file, faces, gallery):
+        imported = True
+    return faces, gallery, imported
+
+# ------------------ ЗБЕРЕЖЕННЯ НА ДИСК ------------------
+
+def journal_put_record(face, encoding=None):
+    """Запис журналу: обличчя додано або змінено (з кодуванням, якщо воно змінилося)."""
+    record = {"op": "put", "face": face.to_json()}
+    if encoding is not None:
+        record["encoding"] = np.asarray(encoding).tolist()
+    return record
+
+
+def journal_delete_record(face_id):
+    return {"op": "delete", "id": face_id}
+
+
+def replay_face_journal(path, faces, gallery):
+    """
+    Застосовує журнал змін поверх знімка, завантаженого з face_data.json.
+    Записи ідемпотентні, тож журнал, уже врахований у знімку, можна застосувати повторно.
+    Обірваний останній рядок (збій під час запису) пропускається. Повертає кількість записів.
+    """
+    if not os.path.exists(path):
+        return 0
+    applied = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"Пошкоджений запис журналу {path}, решту пропущено")
+                break
+            if record["op"] == "delete":
+                faces.remove(record["id"])
+                gallery.remove(record["id"])
+            else:
+                data = record["face"]
+                face = faces.get(data["id"])
+                if face is None:
+                    face = faces.add(FaceRecord.from_json(data))
+                else:
+                    faces.rename(face, data["name"])
+                    face.description = data.get("description", "")
+                    face.image_path = data.get("image_path", "")
+                    face.encoding_path = data.get("encoding_path", "")
+                encoding = record.get("encoding")
+                if encoding is not None:
+                    gallery.add(face, np.asarray(encoding, dtype=np.float32))
+                elif face.id not in gallery and os.path.exists(face.encoding_path):
+                    gallery.add(face, np.load(face.encoding_path))
+            applied += 1
+    return applied
+
+
+def write_json_atomic(path, data):
+    """Записує JSON у тимчасовий файл і підміняє ним path, тож файл ніколи не буває записаним наполовину."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def save_jpeg(path, image):
+    if not image.save(path, "JPG"):
+        raise OSError(f"не вдалося зберегти зображення {path}")
+
+
+def image_to_jpeg(image, max_size=None):
+    """Стискає QImage у JPEG (bytes); max_size – зменшити до такого розміру більшої сторони."""
+    if max_size is not None and max(image.width(), image.height()) > max_size:
+        image = image.scaled(max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, "JPG")
+    return bytes(buffer.data())
+
+
+def prepare_face_folder(old_folder, new_folder):
+    """Перейменовує теку обличчя (якщо змінилося ім'я) або створює нову."""
+    if old_folder != new_folder and os.path.exists(old_folder) and not os.path.exists(new_folder):
+        os.rename(old_folder, new_folder)
+    else:
+        os.makedirs(new_folder, exist_ok=True)
+
+
+def remove_face_folder(face_folder):
+    if os.path.exists(face_folder):
+        shutil.rmtree(face_folder)
+        print(f"Видалено папку обличчя: {face_folder}")
+
+
+class SQLiteFaceStore:
+    """
+    Сховище галереї в одному файлі SQLite замість face_data.json і тек облич.
+    Кожне обличчя – рядок таблиці faces (індекси за id та ім'ям) з кодуванням як BLOB float32,
+    повним зображенням і мініатюрою як JPEG. Кожна зміна – окрема транзакція, тож файл не
+    розходиться з метаданими. Уся матриця кодувань читається одним запитом прямо в масив NumPy.
+    SQLite-з'єднання не можна ділити між потоками, тож кожен потік отримує власне.
+    """
+
+    THUMBNAIL_SIZE = 96
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS faces (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            image_path TEXT NOT NULL DEFAULT '',
+            encoding_path TEXT NOT NULL DEFAULT '',
+            encoding BLOB,
+            image BLOB,
+            thumbnail BLOB
+        );
+        CREATE INDEX IF NOT EXISTS faces_name ON faces (name);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # WAL: читачі (GUI, мініатюри) не чекають на запис у потоці FaceDataWriter
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+    def load(self):
+        """Повертає (FaceRegistry, FaceGallery) з усіма обличчями бази."""
+        rows = self._connection().execute(
+            "SELECT id, name, description, image_path, encoding_path, encoding FROM faces ORDER BY id").fetchall()
+        faces = FaceRegistry()
+        encoded_faces = []
+        blobs = []
+        for face_id, name, description, image_path, encoding_path, blob in rows:
+            face = faces.add(FaceRecord(face_id, name, description, image_path, encoding_path))
+            if blob is not None:
+                encoded_faces.append(face)
+                blobs.append(blob)
+        gallery = FaceGallery()
+        if blobs:
+            # Усі BLOB-и склеюються в один буфер, який стає матрицею без копіювання по рядках
+            matrix = np.frombuffer(bytearray(b"".join(blobs)), dtype=np.float32)
+            gallery.assign(encoded_faces, matrix.reshape(len(blobs), FaceGallery.ENCODING_SIZE))
+        return faces, gallery
+
+    def put(self, data, encoding=None, image=None):
+        """
+        Додає або оновлює обличчя (data – FaceRecord.to_json()) однією транзакцією.
+        encoding та image (QImage) перезаписуються, лише якщо їх передано.
+        """
+        encoding_blob = None
+        if encoding is not None:
+            encoding_blob = np.asarray(encoding, dtype=np.float32).reshape(FaceGallery.ENCODING_SIZE).tobytes()
+        image_blob = thumbnail_blob = None
+        if image is not None:
+            image_blob = image_to_jpeg(image)
+            thumbnail_blob = image_to_jpeg(image, self.THUMBNAIL_SIZE)
+        with self._connection() as connection:
+            connection.execute(
+                """
+                INSERT INTO faces (id, name, description, image_path, encoding_path, encoding, image, thumbnail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    name = excluded.name,
+                    description = excluded.description,
+                    image_path = excluded.image_path,
+                    encoding_path = excluded.encoding_path,
+                    encoding = COALESCE(excluded.encoding, encoding),
+                    image = COALESCE(excluded.image, image),
+                    thumbnail = COALESCE(excluded.thumbnail, thumbnail)
+                """,
+                (data["id"], data["name"], data["description"], data["image_path"], data["encoding_path"],
+                 encoding_blob, image_blob, thumbnail_blob))
+
+    def delete(self, face_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM faces WHERE id = ?", (face_id,))
+
+    def import_faces(self, faces, gallery):
+        """Переносить галерею з face_data.json в порожню базу однією транзакцією (зображення лишаються файлами)."""
+        rows = []
+        for face in faces:
+            encoding = gallery.encoding(face.id)
+            blob = None if encoding is None else encoding.astype(np.float32).tobytes()
+            rows.append((face.id, face.name, face.description, face.image_path, "", blob))
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO faces (id, name, description, image_path, encoding_path, encoding) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def image(self, face_id):
+        row = self._connection().execute("SELECT image FROM faces WHERE id = ?", (face_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def thumbnail(self, face_id):
+        row = self._connection().execute("SELECT thumbnail FROM faces WHERE id = ?", (face_id,)).fetchone()
+        return None if row is None else row[0]
+
+
+class FaceDataWriter(QThread):
+    """
+    Фоновий потік, що виконує весь дисковий ввід-вивід галереї по черзі, у порядку надходження:
+    збереження зображень і кодувань, перейменування та видалення тек, журнал змін.
+    Кожна зміна метаданих дописується рядком JSON у журнал і скидається на диск (fsync);
+    після цього зміна підтверджується сигналом journaled. Коли журнал стає великим порівняно
+    зі знімком (не менше compact_every записів і не менше половини snapshot_size облич),
+    snapshot() атомарно переписує face_data.json і матрицю галереї, а журнал очищується.
+    Поріг росте разом з галереєю, тож масова реєстрація N облич переписує знімок O(log N)
+    разів, а не N / compact_every. load_face_data застосовує журнал поверх останнього знімка.
+    Без journal_path (сховище SQLiteFaceStore, яке саме транзакційне) журнал не ведеться.
+    """
+
+    image_saved = Signal(object)  # id обличчя, чиє зображення записано на диск
+    journaled = Signal(int)       # кількість щойно підтверджених записів журналу
+
+    def __init__(self, journal_path=None, snapshot=None, compact_every=500, parent=None):
+        super().__init__(parent)
+        self.journal_path = journal_path
+        self.snapshot = snapshot
+        self.compact_every = compact_every
+        self._tasks = deque()
+        # Зображення, що ще чекають на запис: діалоги беруть їх звідси замість старого файлу
+        self._pending_images = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._journal = None
+        self._records = 0
+        # Кількість облич в останньому знімку; snapshot() повертає нове значення
+        self.snapshot_size = 0
+
+    def _put(self, task):
+        with self._cond:
+            self._tasks.append(task)
+            self._cond.notify()
+
+    def submit(self, fn, *args):
+        """Ставить у чергу довільну дискову операцію fn(*args)."""
+        self._put(("call", fn, args))
+
+    def journal(self, record):
+        self._put(("journal", record))
+
+    def save_image(self, face_id, image, write):
+        """
+        Записує зображення обличчя (QImage – QPixmap у фоновому потоці використовувати не можна)
+        викликом write(image). Поки запис у черзі, pending_image(face_id) повертає це зображення.
+        """
+        with self._cond:
+            self._pending_images[face_id] = image
+        self._put(("image", face_id, image, write))
+
+    def pending_image(self, face_id):
+        with self._cond:
+            return self._pending_images.get(face_id)
+
+    def compact(self):
+        self._put(("compact",))
+
+    def stop(self):
+        """Дописує все, що є в черзі, і зупиняє потік."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.wait()
+
+    def run(self):
+        if self.journal_path is None:
+            while self._next_batch():
+                pass
+            return
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb+") as f:
+                data = f.read()
+                # Обірваний останній рядок відрізаємо, інакше з ним злиється наступний запис
+                end = data.rfind(b"\n") + 1
+                if end != len(data):
+                    f.truncate(end)
+                self._records = data.count(b"\n")
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        try:
+            while self._next_batch():
+                pass
+        finally:
+            self._journal.close()
+
+    def _next_batch(self):
+        """Виконує все, що накопичилось у черзі. False – потік зупинено і черга порожня."""
+        with self._cond:
+            while not self._tasks and not self._stopping:
+                self._cond.wait()
+            if not self._tasks:
+                return False
+            batch = list(self._tasks)
+            self._tasks.clear()
+        self._run_batch(batch)
+        return True
+
+    def _run_batch(self, batch):
+        written = 0
+        for task in batch:
+            try:
+                if task[0] == "journal":
+                    self._journal.write(json.dumps(task[1], ensure_ascii=False) + "\n")
+                    written += 1
+                elif task[0] == "image":
+                    _, face_id, image, write = task
+                    try:
+                        write(image)
+                    finally:
+                        with self._cond:
+                            if self._pending_images.get(face_id) is image:
+                                del self._pending_images[face_id]
+                    self.image_saved.emit(face_id)
+                elif task[0] == "call":
+                    task[1](*task[2])
+                elif task[0] == "compact":
+                    self._compact()
+            except Exception as e:
+                print("Помилка запису даних облич:", e)
+        if written:
+            # Групове підтвердження: один fsync на всі записи пакета
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._records += written
+            self.journaled.emit(written)
+        if self._records >= max(self.compact_every, self.snapshot_size // 2):
+            try:
+                self._compact()
+            except Exception as e:
+                print("Помилка стиснення журналу:", e)
+
+    def _compact(self):
+        """Атомарно переписує знімок і очищує журнал (знімок уже містить усі його зміни)."""
+        if self._journal is None:
+            return
+        self._journal.flush()
+        self.snapshot_size = self.snapshot() or 0
+        self._journal.close()
+        self._journal = open(self.journal_path, "w", encoding="utf-8")
+        self._records = 0
+
+# ------------------ МЕТРИКИ ------------------
+
+METRICS_PREFIX = "pyfaceid"
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class RollingHistogram:
+    """Останні window вимірювань (для перцентилів) плюс загальні лічильники кількості та суми за весь час."""
+
+    def __init__(self, window=300):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantiles(self, quantiles=METRICS_QUANTILES):
+        if not self.samples:
+            return [0.0 for _ in quantiles]
+        return [float(value) for value in np.quantile(np.fromiter(self.samples, dtype=np.float64), quantiles)]
+
+
+class PipelineMetrics:
+    """
+    Потокобезпечний збирач метрик конвеєра: ковзні гістограми тривалості етапів (секунди),
+    лічильники подій та поточні значення (gauges). Кожна метрика може мати мітку camera.
+    Вміст експортується у форматі textfile для Prometheus node_exporter або в JSON.
+    """
+
+    STAGE_HELP = "Duration of a recognition pipeline stage in seconds"
+
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, stage, seconds, camera=None):
+        with self._lock:
+            histogram = self._histograms.get((stage, camera))
+            if histogram is None:
+                histogram = self._histograms[(stage, camera)] = RollingHistogram(self.window)
+            histogram.record(seconds)
+
+    def increment(self, name, value=1, camera=None):
+        with self._lock:
+            self._counters[(name, camera)] = self._counters.get((name, camera), 0) + value
+
+    def set_counter(self, name, value, camera=None):
+        """Встановлює накопичене значення лічильника, який рахується деінде (наприклад, у черзі)."""
+        with self._lock:
+            self._counters[(name, camera)] = value
+
+    def set_gauge(self, name, value, camera=None):
+        with self._lock:
+            self._gauges[(name, camera)] = value
+
+    def stage_quantiles(self, stage, camera=None):
+        """Повертає (p50, p90, p99) етапу в секундах або None, якщо вимірювань ще не було."""
+        with self._lock:
+            histogram = self._histograms.get((stage, camera))
+            return histogram.quantiles() if histogram and histogram.samples else None
+
+    def counter(self, name, camera=None):
+        with self._lock:
+            return self._counters.get((name, camera), 0)
+
+    def gauge(self, name, camera=None):
+        with self._lock:
+            return self._gauges.get((name, camera), 0)
+
+    def snapshot(self):
+        """Знімок усіх метрик у вигляді словника для JSON."""
+        with self._lock:
+            stages = []
+            for (stage, camera), histogram in sorted(self._histograms.items(), key=lambda item: str(item[0])):
+                stages.append({
+                    "stage": stage,
+                    "camera": camera,
+                    "count": histogram.count,
+                    "sum_seconds": histogram.total,
+                    "quantiles": dict(zip((str(q) for q in METRICS_QUANTILES), histogram.quantiles())),
+                })
+            counters = [{"name": name, "camera": camera, "value": value}
+                        for (name, camera), value in sorted(self._counters.items(), key=lambda item: str(item[0]))]
+            gauges = [{"name": name, "camera": camera, "value": value}
+                      for (name, camera), value in sorted(self._gauges.items(), key=lambda item: str(item[0]))]
+        return {"timestamp": time.time(), "stages": stages, "counters": counters, "gauges": gauges}
+
+    def to_prometheus(self):
+        """Метрики у текстовому форматі експозиції Prometheus."""
+        snapshot = self.snapshot()
+
+        def labels(**values):
+            pairs = [f'{key}="{value}"' for key, value in values.items() if value is not None]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        metric = f"{METRICS_PREFIX}_stage_duration_seconds"
+        lines = [f"# HELP {metric} {self.STAGE_HELP}", f"# TYPE {metric} summary"]
+        for item in snapshot["stages"]:
+            for quantile, value in item["quantiles"].items():
+                lines.append(f"{metric}{labels(stage=item['stage'], camera=item['camera'], quantile=quantile)} {value:.6f}")
+            lines.append(f"{metric}_sum{labels(stage=item['stage'], camera=item['camera'])} {item['sum_seconds']:.6f}")
+            lines.append(f"{metric}_count{labels(stage=item['stage'], camera=item['camera'])} {item['count']}")
+        for kind, items, suffix in (("counter", snapshot["counters"], "_total"), ("gauge", snapshot["gauges"], "")):
+            for name in dict.fromkeys(item["name"] for item in items):
+                metric = f"{METRICS_PREFIX}_{name}{suffix}"
+                lines.append(f"# TYPE {metric} {kind}")
+                for item in items:
+                    if item["name"] == name:
+                        lines.append(f"{metric}{labels(camera=item['camera'])} {item['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Атомарно записує метрики у файл: .json – JSON, інакше – textfile для Prometheus.
+        node_exporter не повинен бачити напівзаписаний файл, тому спершу пишемо тимчасовий.
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.to_prometheus()
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+
+# ------------------ КОНВЕЄР ОБРОБКИ КАДРІВ ------------------
+
+class FrameQueue:
+    """
+    Обмежена черга між етапами конвеєра.
+    Якщо наступний етап не встигає, найстаріший елемент відкидається – у живому відео
+    важливіший свіжий кадр, ніж повна історія.
+    """
+
+    def __init__(self, maxsize=2):
+        self._items = deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._items) >= self._maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=0.1):
+        """Повертає наступний елемент або None, якщо за timeout секунд нічого не надійшло."""
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+# Індекси точок 68-точкової моделі dlib для кожної частини обличчя (як у face_recognition.face_landmarks)
+LANDMARK_FEATURES = {
+    "chin": list(range(0, 17)),
+    "left_eyebrow": list(range(17, 22)),
+    "right_eyebrow": list(range(22, 27)),
+    "nose_bridge": list(range(27, 31)),
+    "nose_tip": list(range(31, 36)),
+    "left_eye": list(range(36, 42)),
+    "right_eye": list(range(42, 48)),
+    "top_lip": list(range(48, 55)) + [64, 63, 62, 61, 60],
+    "bottom_lip": list(range(54, 60)) + [48, 60, 67, 66, 65, 64],
+}
+
+
+def face_shapes(rgb_frame, face_locations):
+    """5-точкові форми облич (dlib) – спільні для FaceQualityGate та енкодера."""
+    return [face_recognition.api.pose_predictor_5_point(rgb_frame, dlib.rectangle(left, top, right, bottom))
+            for (top, right, bottom, left) in face_locations]
+
+
+def analyze_faces(rgb_frame, face_locations, with_landmarks=False, shapes=None):
+    """
+    Обчислює кодування (і за потреби landmarks) для всіх облич кадру за один прохід.
+    Форми облич для енкодера рахуються один раз на обличчя 5-точковою моделью (як у
+    face_recognition.face_encodings, тож кодування сумісні з галереєю) і передаються в енкодер
+    одним пакетним викликом; shapes – уже пораховані форми (face_shapes). 68-точкова модель
+    запускається лише коли увімкнено накладання landmarks.
+    Повертає (encodings, landmarks) – списки в порядку face_locations.
+    """
+    if not face_locations:
+        return [], []
+    if shapes is None:
+        shapes = face_shapes(rgb_frame, face_locations)
+    detections = dlib.full_object_detections()
+    for shape in shapes:
+        detections.append(shape)
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(rgb_frame, detections, 1)
+    encodings = [np.array(descriptor) for descriptor in descriptors]
+
+    if not with_landmarks:
+        return encodings, [{} for _ in encodings]
+    return encodings, [extract_landmarks(rgb_frame, shape.rect) for shape in shapes]
+
+
+def extract_landmarks(rgb_frame, rect):
+    """Повертає словник landmarks (частина обличчя -> список точок) для одного прямокутника dlib."""
+    shape = face_recognition.api.pose_predictor_68_point(rgb_frame, rect)
+    points = [(point.x, point.y) for point in shape.parts()]
+    return {feature: [points[i] for i in indices] for feature, indices in LANDMARK_FEATURES.items()}
+
+
+class FaceQualityGate:
+    """
+    Дешева перевірка якості обличчя перед енкодером: замалі рамки, розмиття (дисперсія лапласіана
+    на зменшеній до SAMPLE_SIZE копії), надто темні чи пересвічені обличчя та сильний поворот голови
+    (зсув носа від середини очей за 5-точковою формою, у частках відстані між очима).
+    Такі обличчя майже ніколи надійно не розпізнаються, тож 128-вимірне кодування та пошук
+    у галереї для них не запускаються. Поріг 0 (або None для яскравості) вимикає відповідну перевірку.
+    """
+
+    SAMPLE_SIZE = 96
+    REASONS = ("small", "blurry", "dark", "bright", "pose")
+
+    def __init__(self, min_size=40, min_sharpness=25.0, min_brightness=40, max_brightness=220, max_yaw=0.45):
+        self.min_size = min_size
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_yaw = max_yaw
+        self.skipped = dict.fromkeys(self.REASONS, 0)
+        self.passed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def yaw(shape):
+        """Поворот голови за 5-точковою формою: 0 – анфас, ~1 – профіль."""
+        points = shape.parts()
+        right_eye_x = (points[0].x + points[1].x) / 2.0
+        right_eye_y = (points[0].y + points[1].y) / 2.0
+        left_eye_x = (points[2].x + points[3].x) / 2.0
+        left_eye_y = (points[2].y + points[3].y) / 2.0
+        eye_distance = math.hypot(left_eye_x - right_eye_x, left_eye_y - right_eye_y)
+        if eye_distance == 0:
+            return float("inf")
+        return abs(points[4].x - (right_eye_x + left_eye_x) / 2.0) / eye_distance
+
+    def issue(self, rgb_frame, location, shape=None):
+        """Причина відмови (одна з REASONS) або None, якщо обличчя варто кодувати."""
+        top, right, bottom, left = location
+        if min(right - left, bottom - top) < self.min_size:
+            return "small"
+        crop = rgb_frame[max(top, 0):bottom, max(left, 0):right]
+        if crop.size == 0:
+            return "small"
+        gray = cv2.resize(cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY), (self.SAMPLE_SIZE, self.SAMPLE_SIZE),
+                          interpolation=cv2.INTER_AREA)
+        brightness = gray.mean()
+        if self.min_brightness and brightness < self.min_brightness:
+            return "dark"
+        if self.max_brightness and brightness > self.max_brightness:
+            return "bright"
+        if self.min_sharpness and cv2.Laplacian(gray, cv2.CV_64F).var() < self.min_sharpness:
+            return "blurry"
+        if self.max_yaw and shape is not None and self.yaw(shape) > self.max_yaw:
+            return "pose"
+        return None
+
+    def check(self, rgb_frame, location, shape=None):
+        """Як issue, але ще й рахує результат у лічильниках skipped/passed."""
+        reason = self.issue(rgb_frame, location, shape)
+        with self._lock:
+            if reason is None:
+                self.passed += 1
+            else:
+                self.skipped[reason] += 1
+        return reason
+
+    def __str__(self):
+        with self._lock:
+            skipped = ", ".join(f"{reason} {count}" for reason, count in self.skipped.items())
+            return f"passed {self.passed}, skipped: {skipped}"
+
+
+class DetectionResolution:
+    """
+    Роздільна здатність, на якій шукаються обличчя: фіксований масштаб (0.5) або цільова ширина (640).
+    Детекція HOG на повному кадрі 1080p займає сотні мілісекунд, тому кадр зменшується,
+    а знайдені рамки переводяться назад у координати повного кадру.
+    """
+
+    def __init__(self, scale=None, width=None):
+        self.scale = scale
+        self.width = width
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Розбирає значення з поля вводу: "0.5" – масштаб, "640" – ширина в пікселях,
+        "0" – повна роздільна здатність. Порожній рядок означає автоматичний вибір (None).
+        """
+        text = text.strip()
+        if not text:
+            return None
+        if "." in text:
+            scale = float(text)
+            if not 0 < scale <= 1:
+                raise ValueError("scale must be in (0, 1]")
+            return cls(scale=scale)
+        width = int(text)
+        if width < 0:
+            raise ValueError("width must not be negative")
+        return cls(width=width or None)
+
+    @classmethod
+    def auto(cls, frame_width):
+        """Вибір за замовчуванням за шириною кадру, яку повідомляє cv2.VideoCapture."""
+        if not frame_width or frame_width <= 640:
+            return cls()
+        if frame_width <= 1280:
+            return cls(width=640)
+        return cls(width=960)
+
+    def scale_for(self, frame_width):
+        if self.scale:
+            return min(self.scale, 1.0)
+        if self.width and frame_width > self.width:
+            return self.width / frame_width
+        return 1.0
+
+    def __str__(self):
+        if self.scale:
+            return f"scale {self.scale:g}"
+        if self.width:
+            return f"width {self.width}px"
+        return "full resolution"
+
+
+def detect_faces(rgb_frame, detection_model="hog", scale=1.0):
+    """Шукає обличчя на зменшеній у scale разів копії кадру та повертає рамки в координатах повного кадру."""
+    if scale >= 1.0:
+        return face_recognition.face_locations(rgb_frame, model=detection_model)
+
+    small_frame = cv2.resize(rgb_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small_locations = face_recognition.face_locations(small_frame, model=detection_model)
+    h_frame, w_frame = rgb_frame.shape[:2]
+    return [
+        (max(int(top / scale), 0), min(int(right / scale), w_frame),
+         min(int(bottom / scale), h_frame), max(int(left / scale), 0))
+        for (top, right, bottom, left) in small_locations
+    ]
+
+
+def analyze_frame(rgb_frame, detection_model="hog", with_landmarks=False, detection_scale=1.0):
+    """Знаходить обличчя на кадрі та повертає список (bbox, encoding, landmarks) для кожного з них."""
+    face_locations = detect_faces(rgb_frame, detection_model, detection_scale)
+    encodings, landmarks = analyze_faces(rgb_frame, face_locations, with_landmarks)
+    return [
+        ((left, top, right - left, bottom - top), encoding, face_landmarks)
+        for (top, right, bottom, left), encoding, face_landmarks in zip(face_locations, encodings, landmarks)
+    ]
+
+
+# ------------------ СУПРОВІД ОБЛИЧ ------------------
+
+def box_iou(a, b):
+    """IoU двох рамок у форматі face_recognition (top, right, bottom, left)."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    if inter == 0:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter)
+
+
+class Track:
+    """Обличчя, яке супроводжується між кадрами. face – запис збереженого або невідомого обличчя."""
+
+    def __init__(self, track_id, location):
+        self.track_id = track_id
+        self.location = location  # (top, right, bottom, left)
+        self.face = None
+        self.points = None
+        self.confidence = 1.0
+        self.missed = 0
+        # Стан кешу кодування: останнє кодування треку та рамка/час/кадр, коли його обчислено
+        self.encoding = None
+        self.encoded_location = None
+        self.encoded_at = 0.0
+        self.frames_since_encoding = 0
+        # Причина, з якої FaceQualityGate не пустив обличчя до енкодера (None – пройшло)
+        self.quality_issue = None
+
+
+class FaceTracker:
+    """
+    Супровід облич між детекціями (track-by-detection).
+    На ключових кадрах рамки детектора зіставляються з наявними треками за IoU, тож трек
+    зберігає свій id та особу. Між ключовими кадрами рамки зсуваються за оптичним потоком
+    Лукаса-Канаде по характерних точках всередині обличчя. Якщо точки губляться,
+    трек видаляється, а needs_detection просить детекцію на наступному кадрі.
+    """
+
+    MAX_POINTS = 30
+    MIN_POINTS = 4
+
+    def __init__(self, min_confidence=0.5, iou_threshold=0.3, max_missed=0):
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks = []
+        self.needs_detection = True
+        self._next_track_id = 1
+        self._prev_gray = None
+
+    def update(self, rgb_frame, face_locations=None):
+        """
+        Оновлює треки за новим кадром. face_locations – результат детекції на ключовому кадрі
+        або None, якщо детекція на цьому кадрі не запускалась. Повертає список активних треків.
+        """
+        gray = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY)
+        self.needs_detection = False
+        if face_locations is not None:
+            self._associate(gray, face_locations)
+        elif self._prev_gray is not None and self._prev_gray.shape == gray.shape:
+            self._propagate(gray)
+        self._prev_gray = gray
+        return self.tracks
+
+    def _associate(self, gray, face_locations):
+        pairs = sorted(
+            ((box_iou(track.location, location), t, d)
+             for t, track in enumerate(self.tracks)
+             for d, location in enumerate(face_locations)),
+            reverse=True
+        )
+        used_tracks, used_detections = set(), set()
+        for iou, t, d in pairs:
+            if iou < self.iou_threshold:
+                break
+            if t in used_tracks or d in used_detections:
+                continue
+            used_tracks.add(t)
+            used_detections.add(d)
+            track = self.tracks[t]
+            track.location = face_locations[d]
+            track.missed = 0
+            track.confidence = 1.0
+            self._seed_points(gray, track)
+
+        tracks = []
+        for t, track in enumerate(self.tracks):
+            if t not in used_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            tracks.append(track)
+        for d, location in enumerate(face_locations):
+            if d not in used_detections:
+                track = Track(self._next_track_id, location)
+                self._next_track_id += 1
+                self._seed_points(gray, track)
+                tracks.append(track)
+        self.tracks = tracks
+
+    def _seed_points(self, gray, track):
+        top, right, bottom, left = track.location
+        # Беремо центральну частину рамки, щоб не чіпляти точки фону
+        pad_x, pad_y = (right - left) // 8, (bottom - top) // 8
+        roi = gray[top + pad_y:bottom - pad_y, left + pad_x:right - pad_x]
+        points = None
+        if roi.size:
+            points = cv2.goodFeaturesToTrack(roi, self.MAX_POINTS, 0.01, 3)
+        if points is None or len(points) < self.MIN_POINTS:
+            track.points = None
+            return
+        points[:, 0, 0] += left + pad_x
+        points[:, 0, 1] += top + pad_y
+        track.points = points.astype(np.float32)
+
+    def _propagate(self, gray):
+        tracks = [track for track in self.tracks if track.points is not None]
+        if len(tracks) != len(self.tracks):
+            self.needs_detection = True
+        if not tracks:
+            self.tracks = []
+            return
+
+        # Усі точки всіх треків – одним викликом, щоб піраміди зображень будувалися один раз
+        all_points = np.concatenate([track.points for track in tracks])
+        new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._prev_gray, gray, all_points, None, winSize=(15, 15), maxLevel=2
+        )
+        status = status.reshape(-1).astype(bool)
+
+        h_frame, w_frame = gray.shape
+        alive = []
+        offset = 0
+        for track in tracks:
+            count = len(track.points)
+            ok = status[offset:offset + count]
+            old = track.points[ok].reshape(-1, 2)
+            new = new_points[offset:offset + count][ok].reshape(-1, 2)
+            offset += count
+
+            track.confidence = ok.mean()
+            if len(new) < self.MIN_POINTS or track.confidence < self.min_confidence:
+                self.needs_detection = True
+                continue
+
+            dx, dy = np.median(new - old, axis=0)
+            old_spread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+            new_spread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+            scale = float(np.clip(np.median(new_spread / np.maximum(old_spread, 1e-3)), 0.8, 1.25))
+
+            top, right, bottom, left = track.location
+            cx, cy = (left + right) / 2 + dx, (top + bottom) / 2 + dy
+            half_w, half_h = (right - left) * scale / 2, (bottom - top) * scale / 2
+            track.location = (
+                max(int(cy - half_h), 0), min(int(cx + half_w), w_frame),
+                min(int(cy + half_h), h_frame), max(int(cx - half_w), 0)
+            )
+            if track.location[1] <= track.location[3] or track.location[2] <= track.location[0]:
+                self.needs_detection = True
+                continue
+            track.points = new.reshape(-1, 1, 2)
+            alive.append(track)
+        self.tracks = alive
+
+
+class TrackEncodingCache:
+    """
+    Кеш кодування та особи на рівні треку.
+    Поки трек стабільний, його кодування та особа використовуються повторно. Повторне кодування
+    (і порівняння з галереєю) відбувається, коли рамка суттєво змістилась відносно рамки,
+    на якій рахувалось кодування (IoU < min_iou), коли кодування старше за max_age секунд
+    або кожні sample_interval кадрів треку (0 – вимкнено).
+    Лічильники hits/misses показують, скільки кодувань вдалося не рахувати.
+    """
+
+    def __init__(self, min_iou=0.5, max_age=2.0, sample_interval=50):
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.sample_interval = sample_interval
+        self.hits = 0
+        self.misses = 0
+
+    def needs_encoding(self, track, now):
+        track.frames_since_encoding += 1
+        stale = (
+            track.encoding is None
+            or box_iou(track.location, track.encoded_location) < self.min_iou
+            or (self.max_age and now - track.encoded_at > self.max_age)
+            or (self.sample_interval and track.frames_since_encoding >= self.sample_interval)
+        )
+        if stale:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stale
+
+    def store(self, track, encoding, now):
+        track.encoding = encoding
+        track.encoded_location = track.location
+        track.encoded_at = now
+        track.frames_since_encoding = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return f"hits {self.hits}, misses {self.misses} ({self.hit_rate():.0%} encodings saved)"
+
+
+class UnknownFaceStore:
+    """
+    Невідомі обличчя, які бачили нещодавно, з кодуваннями в буфері фіксованої місткості.
+    Кодування лежать суцільним масивом float32, тож пошук найближчого невідомого – одне
+    векторне обчислення відстаней. Обличчя живе ttl секунд після останньої появи на будь-якій
+    камері (див. touch); коли буфер заповнено, витісняється те, яке бачили найдавніше.
+    Для діалогу захоплення зберігається лише сирий фрагмент кадру (FaceRecord.crop),
+    QPixmap з нього створюється в GUI-потоці тільки під час захоплення.
+    """
+
+    def __init__(self, capacity=256, ttl=30.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._matrix = np.empty((capacity, FaceGallery.ENCODING_SIZE), dtype=np.float32)
+        self._last_seen = np.empty(capacity, dtype=np.float64)
+        self._faces = []       # рядок -> FaceRecord
+        self._rows = {}        # id обличчя -> рядок
+        self._next_id = 1
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._faces)
+
+    def __iter__(self):
+        return iter(list(self._faces))
+
+    def is_current(self, face):
+        """Чи саме цей запис досі зберігається (а не витіснений чи вже захоплений)."""
+        row = self._rows.get(face.id)
+        return row is not None and self._faces[row] is face
+
+    def match(self, encoding, tolerance=MATCH_TOLERANCE):
+        """Повертає найближче невідоме обличчя в межах tolerance або None."""
+        count = len(self._faces)
+        if count == 0:
+            return None
+        vector = np.asarray(encoding, dtype=np.float32).reshape(FaceGallery.ENCODING_SIZE)
+        distances = np.linalg.norm(self._matrix[:count] - vector, axis=1)
+        row = int(np.argmin(distances))
+        return self._faces[row] if distances[row] <= tolerance else None
+
+    def add(self, encoding, now):
+        """Створює запис нового невідомого обличчя; за потреби звільняє місце (TTL, потім LRU)."""
+        if len(self._faces) >= self.capacity:
+            self.expire(now)
+        if len(self._faces) >= self.capacity:
+            oldest = int(np.argmin(self._last_seen[:len(self._faces)]))
+            self.remove(self._faces[oldest].id)
+            self.evicted += 1
+        face_id = self._next_id
+        self._next_id += 1
+        face = FaceRecord(face_id, f"Unknown_{face_id}", encoding=encoding)
+        row = len(self._faces)
+        self._faces.append(face)
+        self._rows[face_id] = row
+        self._matrix[row] = np.asarray(encoding, dtype=np.float32).reshape(FaceGallery.ENCODING_SIZE)
+        self._last_seen[row] = now
+        return face
+
+    def touch(self, face, now):
+        row = self._rows.get(face.id)
+        if row is not None and self._faces[row] is face:
+            self._last_seen[row] = now
+
+    def remove(self, face_id):
+        row = self._rows.pop(face_id, None)
+        if row is None:
+            return
+        last = len(self._faces) - 1
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._last_seen[row] = self._last_seen[last]
+            self._faces[row] = self._faces[last]
+            self._rows[self._faces[row].id] = row
+        self._faces.pop()
+
+    def expire(self, now):
+        """Видаляє обличчя, яких не бачили довше за ttl секунд."""
+        count = len(self._faces)
+        if count == 0:
+            return
+        stale = np.flatnonzero(now - self._last_seen[:count] > self.ttl)
+        for face_id in [self._faces[row].id for row in stale]:
+            self.remove(face_id)
+
+
+class FairFrameQueue:
+    """
+    Спільна черга кадрів кількох камер перед пулом детекції.
+    Кожна камера має власну обмежену чергу (найстаріший кадр відкидається), а get() обходить
+    камери по колу, тож одна швидка камера не може забрати весь пул у решти.
+    """
+
+    def __init__(self, maxsize_per_source=2):
+        self._queues = {}
+        self._order = []
+        self._next = 0
+        self._maxsize = maxsize_per_source
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, source, item):
+        with self._cond:
+            if self._closed:
+                return
+            items = self._queues.get(source)
+            if items is None:
+                items = self._queues[source] = deque()
+                self._order.append(source)
+            if len(items) >= self._maxsize:
+                items.popleft()
+                source.dropped_frames += 1
+            items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=0.1):
+        """Повертає (джерело, елемент) наступної по колу камери з кадрами або None після timeout секунд."""
+        with self._cond:
+            if not self._closed and not any(self._queues.values()):
+                self._cond.wait(timeout)
+            for _ in range(len(self._order)):
+                source = self._order[self._next % len(self._order)]
+                self._next += 1
+                if self._queues[source]:
+                    return source, self._queues[source].popleft()
+            return None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._queues.clear()
+            self._order.clear()
+            self._cond.notify_all()
+
+
+class CameraCapture:
+    """
+    Джерело відео з власним потоком захоплення навколо cv2.VideoCapture.
+    Потік без зупинки забирає кадри з драйвера, тож внутрішній буфер OpenCV не накопичує
+    застарілих кадрів, хоч би як відставала обробка. В однокомірковому буфері лежить лише
+    найсвіжіший кадр разом з моментом захоплення (time.perf_counter() одразу після grab());
+    кадр, який ніхто не встиг забрати, перезаписується наступним (лічильник overwritten).
+    Для камер можна запросити формат (FOURCC, наприклад MJPG чи YUYV), розмір кадру, fps та
+    розмір буфера драйвера; accepted містить значення, які пристрій фактично прийняв.
+    """
+
+    def __init__(self, source, fourcc=None, size=None, fps=None, buffer_size=1):
+        if isinstance(source, (int, str)):
+            self.name = str(source)
+            self.capture = cv2.VideoCapture(source)
+            # Файли відео відтворюються як є, формат запитуємо лише в камер і потоків
+            configurable = not (isinstance(source, str) and os.path.isfile(source))
+        else:
+            # Уже відкрите захоплення (або об'єкт з тим самим інтерфейсом)
+            self.name = type(source).__name__
+            self.capture = source
+            configurable = False
+        self.requested = {}
+        if configurable and self.capture.isOpened():
+            self.requested = {"fourcc": fourcc, "size": size, "fps": fps, "buffer_size": buffer_size}
+            self.configure(fourcc, size, fps, buffer_size)
+        self.accepted = self.read_format() if self.capture.isOpened() else {}
+        self.overwritten = 0
+        self._cond = threading.Condition()
+        self._latest = None
+        self._sequence = 0
+        self._consumed = 0
+        self._stopped = False
+        self._thread = None
+
+    @staticmethod
+    def fourcc_name(code):
+        code = int(code)
+        name = "".join(chr((code >> 8 * i) & 0xFF) for i in range(4))
+        return name if code and name.isprintable() else None
+
+    def configure(self, fourcc=None, size=None, fps=None, buffer_size=None):
+        """
+        Запитує параметри у драйвера. FOURCC задається першим: V4L2 перелічує доступні
+        розміри та fps окремо для кожного формату.
+        """
+        if fourcc:
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if size:
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+        if fps:
+            self.capture.set(cv2.CAP_PROP_FPS, fps)
+        if buffer_size:
+            self.capture.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+
+    def read_format(self):
+        """Параметри, які пристрій фактично прийняв (драйвер може мовчки підставити найближчі)."""
+        try:
+            backend = self.capture.getBackendName()
+        except (cv2.error, AttributeError):
+            backend = None
+        return {
+            "backend": backend,
+            "fourcc": self.fourcc_name(self.capture.get(cv2.CAP_PROP_FOURCC)),
+            "size": (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))),
+            "fps": round(self.capture.get(cv2.CAP_PROP_FPS), 2),
+            "buffer_size": max(int(self.capture.get(cv2.CAP_PROP_BUFFERSIZE)), 0) or None,
+        }
+
+    @staticmethod
+    def describe_format(values):
+        parts = [values.get("fourcc") or "?"]
+        if values.get("size"):
+            parts.append("x".join(str(side) for side in values["size"]))
+        if values.get("fps"):
+            parts.append(f"{values['fps']:g} fps")
+        if values.get("buffer_size"):
+            parts.append(f"buffer {values['buffer_size']}")
+        return " ".join(parts)
+
+    def __str__(self):
+        text = self.describe_format(self.accepted) if self.accepted else "not opened"
+        requested = {key: value for key, value in self.requested.items() if value and key != "buffer_size"}
+        if requested and self.accepted:
+            text += f" (requested {self.describe_format(requested)})"
+        return text
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def get(self, prop):
+        return self.capture.get(prop)
+
+    def start(self):
+        """Запускає потік захоплення (повторний виклик нічого не робить)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"camera {self.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            started = time.perf_counter()
+            if not self.capture.grab():
+                time.sleep(0.01)
+                continue
+            captured_at = time.perf_counter()
+            ret, frame = self.capture.retrieve()
+            if not ret:
+                continue
+            with self._cond:
+                if self._sequence > self._consumed:
+                    self.overwritten += 1
+                self._sequence += 1
+                self._latest = (frame, captured_at, time.perf_counter() - started)
+                self._cond.notify_all()
+
+    def read(self, timeout=0.1):
+        """
+        Повертає ще не прочитаний найсвіжіший кадр як (frame, captured_at, capture_seconds),
+        де capture_seconds – тривалість grab() та декодування, або None після timeout секунд.
+        """
+        with self._cond:
+            if self._sequence == self._consumed and not self._stopped:
+                self._cond.wait(timeout)
+            if self._sequence == self._consumed:
+                return None
+            self._consumed = self._sequence
+            return self._latest
+
+    def release(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        # VideoCapture не можна звільняти, поки інший потік стоїть у grab()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.capture.release()
+
+
+class CaptureWorker(QThread):
+    """
+    Етап 1: забирає найсвіжіші кадри з CameraCapture, нумерує їх і передає в спільний пул детекції.
+    Номери йдуть підряд, навіть якщо камера перезаписала кадри, яких ніхто не встиг забрати.
+    """
+
+    def __init__(self, pipeline, capture, output_queue, parent=None):
+        super().__init__(parent)
+        self.pipeline = pipeline
+        self.capture = capture
+        self.output_queue = output_queue
+
+    def run(self):
+        frame_id = 0
+        metrics = self.pipeline.metrics
+        camera_index = self.pipeline.camera_index
+        self.capture.start()
+        while not self.isInterruptionRequested():
+            item = self.capture.read()
+            if item is None:
+                continue
+            frame, captured_at, capture_seconds = item
+            metrics.observe("capture", capture_seconds, camera_index)
+            metrics.increment("frames_captured", camera=camera_index)
+            frame_id += 1
+            self.output_queue.put(self.pipeline, (frame_id, frame, captured_at))
+
+
+class DetectWorker(QThread):
+    """
+    Етап 2: пошук облич на ключових кадрах. Таких потоків може бути кілька – dlib відпускає GIL.
+    Решта кадрів лише переводиться в RGB і передається трекеру своєї камери.
+    """
+
+    def __init__(self, input_queue, parent=None):
+        super().__init__(parent)
+        self.input_queue = input_queue
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            item = self.input_queue.get()
+            if item is None:
+                continue
+            pipeline, (frame_id, frame, captured_at) = item
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            face_locations = None
+            if pipeline.is_keyframe(frame_id):
+                started = time.perf_counter()
+                detection_scale = pipeline.detection_scale(rgb_frame.shape[1])
+                face_locations = detect_faces(rgb_frame, pipeline.detection_model, detection_scale)
+                pipeline.metrics.observe("detect", time.perf_counter() - started, pipeline.camera_index)
+                pipeline.metrics.increment("detections", camera=pipeline.camera_index)
+            pipeline.analyzed.put((frame_id, rgb_frame, face_locations, captured_at))
+
+
+class DetectorPool:
+    """
+    Пул потоків детекції, спільний для всіх камер. Кадри надходять через FairFrameQueue,
+    тож потоки обслуговують камери по черзі.
+    Кодування облич сюди навмисно не потрапляє: воно залежить від результату трекера своєї камери
+    (див. RecognitionWorker), тож потік камери однаково чекав би на пул, лише з зайвою передачею кадру.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = max(1, min(8, (os.cpu_count() or 2) - 1))
+        self.frames = FairFrameQueue()
+        self.workers = [DetectWorker(self.frames) for _ in range(workers)]
+
+    def __len__(self):
+        return len(self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.requestInterruption()
+        self.frames.close()
+        for worker in self.workers:
+            worker.wait()
+
+
+class RecognitionWorker(QThread):
+    """
+    Етап 3: супровід облич та визначення особи кожного треку однієї камери. Працює в одному потоці,
+    бо трекеру потрібні кадри по порядку. Результат передається у GUI через сигнал.
+    Кодування та пошук у галереї виконуються тут же, а не в спільному DetectorPool. Кожна камера
+    має власний потік, а dlib відпускає GIL, тож кодування різних камер іде паралельно, і зайнята
+    камера не затримує інші. Кодувань і так небагато: лише нові або перевірювані треки
+    (TrackEncodingCache), що пройшли FaceQualityGate.
+    """
+
+    frame_ready = Signal(int, object, object, object)
+
+    def __init__(self, pipeline, identify_faces, input_queue, reorder_window=1, parent=None):
+        super().__init__(parent)
+        self.pipeline = pipeline
+        self.identify_faces = identify_faces
+        self.input_queue = input_queue
+        self.reorder_window = reorder_window
+        self.tracker = FaceTracker()
+        self._frame_times = deque(maxlen=30)
+
+    def run(self):
+        last_frame_id = 0
+        pending = []
+        while not self.isInterruptionRequested():
+            item = self.input_queue.get()
+            if item is not None:
+                heapq.heappush(pending, (item[0], item))
+            # Кілька потоків детекції можуть завершити кадри не по черзі, тому чекаємо
+            # на наступний за номером кадр, поки буфер не переповниться або черга не стихне
+            while pending and (item is None or pending[0][0] == last_frame_id + 1
+                               or len(pending) > self.reorder_window):
+                frame_id, (_, rgb_frame, face_locations, captured_at) = heapq.heappop(pending)
+                if frame_id <= last_frame_id:
+                    continue
+                last_frame_id = frame_id
+                self.process(rgb_frame, face_locations, captured_at)
+
+    def process(self, rgb_frame, face_locations, captured_at=None):
+        metrics = self.pipeline.metrics
+        camera_index = self.pipeline.camera_index
+        started = time.perf_counter()
+        tracks = self.tracker.update(rgb_frame, face_locations)
+        metrics.observe("track", time.perf_counter() - started, camera_index)
+        if self.tracker.needs_detection:
+            self.pipeline.request_detection()
+        detected_faces = self.identify_faces(rgb_frame, tracks, self.pipeline.landmarks_enabled(), camera_index)
+        if captured_at is not None:
+            # Від захоплення кадру камерою до готового результату, включно з очікуванням у чергах
+            latency = time.perf_counter() - captured_at
+            metrics.observe("end_to_end", latency, camera_index)
+            self.pipeline.observe_latency(latency)
+        metrics.increment("frames_processed", camera=camera_index)
+        # Кадр для показу конвертуємо тут, а не в GUI-потоці: QImage.Format_RGB32 (BGRA) малюється
+        # з масштабуванням значно швидше за RGB888
+        display_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGRA)
+
+        self._frame_times.append(time.monotonic())
+        if len(self._frame_times) > 1:
+            self.pipeline.fps = (len(self._frame_times) - 1) / (self._frame_times[-1] - self._frame_times[0])
+        self.frame_ready.emit(camera_index, display_frame, detected_faces, captured_at)
+
+
+class LoadShedder:
+    """
+    Адаптивне зниження якості обробки камери під навантаженням.
+    Раз на check_interval секунд порівнює p90 затримки кадрів (від захоплення до результату)
+    з бюджетом latency_budget: якщо бюджет перевищено, переходить на наступний рівень LEVELS
+    (рідша детекція, менша роздільна здатність детекції, без landmarks); коли затримка кілька
+    перевірок поспіль тримається нижче recover_ratio від бюджету, повертається на рівень вище.
+    Так на слабкому залізі затримка лишається сталою замість черги, що росте.
+    """
+
+    # (множник інтервалу детекції, множник роздільної здатності детекції, landmarks дозволено)
+    LEVELS = (
+        (1, 1.0, True),
+        (2, 1.0, True),
+        (2, 0.75, True),
+        (2, 0.75, False),
+        (4, 0.5, False),
+    )
+
+    def __init__(self, latency_budget=0.25, check_interval=1.0, recover_ratio=0.6, recover_checks=3,
+                 min_samples=5):
+        self.latency_budget = latency_budget
+        self.check_interval = check_interval
+        self.recover_ratio = recover_ratio
+        self.recover_checks = recover_checks
+        self.min_samples = min_samples
+        self.level = 0
+        self.changes = 0
+        self._samples = []
+        self._calm_checks = 0
+        self._checked_at = None
+
+    @property
+    def max_level(self):
+        return len(self.LEVELS) - 1
+
+    @property
+    def interval_factor(self):
+        return self.LEVELS[self.level][0]
+
+    @property
+    def resolution_factor(self):
+        return self.LEVELS[self.level][1]
+
+    @property
+    def landmarks(self):
+        return self.LEVELS[self.level][2]
+
+    def observe(self, seconds, now):
+        """
+        Додає затримку одного кадру; now – time.monotonic(). Повертає True, якщо рівень змінився.
+        Викликається лише з потоку розпізнавання своєї камери.
+        """
+        if not self.latency_budget:
+            return False
+        self._samples.append(seconds)
+        if self._checked_at is None:
+            self._checked_at = now
+        if now - self._checked_at < self.check_interval or len(self._samples) < self.min_samples:
+            return False
+        self._samples.sort()
+        latency = self._samples[int(0.9 * (len(self._samples) - 1))]
+        self._samples.clear()
+        self._checked_at = now
+        if latency > self.latency_budget:
+            self._calm_checks = 0
+            if self.level < self.max_level:
+                self.level += 1
+                self.changes += 1
+                return True
+            return False
+        if latency < self.latency_budget * self.recover_ratio and self.level > 0:
+            self._calm_checks += 1
+            if self._calm_checks >= self.recover_checks:
+                self._calm_checks = 0
+                self.level -= 1
+                self.changes += 1
+                return True
+            return False
+        self._calm_checks = 0
+        return False
+
+    def __str__(self):
+        if self.level == 0:
+            return "full quality"
+        interval, resolution, landmarks = self.LEVELS[self.level]
+        parts = [f"level {self.level}/{self.max_level}", f"detection interval x{interval}"]
+        if resolution < 1.0:
+            parts.append(f"detection resolution x{resolution:g}")
+        if not landmarks:
+            parts.append("no landmarks")
+        return ", ".join(parts)
+
+
+class RecognitionPipeline(QObject):
+    """
+    Конвеєр розпізнавання однієї камери поза GUI-потоком:
+    захоплення -> детекція (спільний DetectorPool) -> супровід/розпізнавання -> рендер.
+    Етапи з'єднані обмеженими чергами, тож під навантаженням зайві кадри відкидаються,
+    а не накопичуються. Готові кадри надходять у віджет через сигнал
+    frame_ready(camera_index, display_frame, detected_faces, captured_at).
+    Детекція запускається раз на detection_interval кадрів або на запит трекера.
+    Під навантаженням LoadShedder рідшає детекцію, зменшує її роздільну здатність і вимикає
+    landmarks; зміна рівня повідомляється сигналом load_level_changed(camera_index, level).
+    Тривалість етапів і лічильники кадрів записуються в metrics (PipelineMetrics).
+    """
+
+    frame_ready = Signal(int, object, object, object)
+    load_level_changed = Signal(int, int)
+
+    def __init__(self, camera_index, capture, identify_faces, detector_pool, detection_resolution=None,
+                 metrics=None, load_shedder=None, parent=None):
+        super().__init__(parent)
+        self.camera_index = camera_index
+        self.capture = capture
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.detection_model = "hog"
+        self.draw_landmarks = False
+        self.detection_interval = DEFAULT_DETECTION_INTERVAL
+        self.load_shedder = load_shedder if load_shedder is not None else LoadShedder()
+        self.fps = 0.0
+        self.dropped_frames = 0
+        self._detection_requested = threading.Event()
+        self._detection_requested.set()
+        if detection_resolution is None:
+            detection_resolution = DetectionResolution.auto(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.detection_resolution = detection_resolution
+
+        self.analyzed = FrameQueue(maxsize=2)
+        self.capture_worker = CaptureWorker(self, capture, detector_pool.frames)
+        self.recognition_worker = RecognitionWorker(self, identify_faces, self.analyzed,
+                                                    reorder_window=len(detector_pool))
+        self.recognition_worker.frame_ready.connect(self.frame_ready)
+
+    def total_dropped_frames(self):
+        """Кадри, відкинуті перед детекцією та перед супроводом."""
+        return self.dropped_frames + self.analyzed.dropped
+
+    def request_detection(self):
+        """Просить запустити детекцію на найближчому кадрі (трекер втратив обличчя)."""
+        self._detection_requested.set()
+
+    def landmarks_enabled(self):
+        """Landmarks увімкнено користувачем і не вимкнено через навантаження."""
+        return self.draw_landmarks and self.load_shedder.landmarks
+
+    def detection_scale(self, frame_width):
+        return self.detection_resolution.scale_for(frame_width) * self.load_shedder.resolution_factor
+
+    def observe_latency(self, seconds):
+        """Передає затримку кадру в LoadShedder (потік розпізнавання) і повідомляє про зміну рівня."""
+        if self.load_shedder.observe(seconds, time.monotonic()):
+            self.metrics.increment("load_level_changes", camera=self.camera_index)
+            self.load_level_changed.emit(self.camera_index, self.load_shedder.level)
+
+    def is_keyframe(self, frame_id):
+        if frame_id % max(self.detection_interval * self.load_shedder.interval_factor, 1) == 0:
+            return True
+        if self._detection_requested.is_set():
+            self._detection_requested.clear()
+            return True
+        return False
+
+    def start(self):
+        self.recognition_worker.start()
+        self.capture_worker.start()
+
+    def stop(self):
+        workers = [self.capture_worker, self.recognition_worker]
+        for worker in workers:
+            worker.requestInterruption()
+        self.analyzed.close()
+        for worker in workers:
+            worker.wait()
+
+# ------------------ РЕЄСТРАЦІЯ ОБЛИЧ ------------------
+
+def encode_image_file(image_path, known_digest=None):
+    """
+    Виконується в пулі процесів: рахує SHA-1 вмісту зображення та кодування першого обличчя на ньому.
+    Якщо хеш збігається з known_digest, кодування не рахується (повертається None).
+    Повертає (digest, encoding, error).
+    """
+    try:
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        if digest == known_digest:
+            return digest, None, None
+        image = face_recognition.load_image_file(image_path)
+        encodings = face_recognition.face_encodings(image)
+        return digest, (encodings[0] if encodings else None), None
+    except Exception as e:
+        return None, None, str(e)
+
+
+class EnrollmentWorker(QThread):
+    """
+    Фонова реєстрація облич: детекція та кодування зображень у пулі процесів.
+    Кожен результат передається у GUI сигналом enrolled(job, digest, encoding, error),
+    прогрес – сигналом progress(кількість оброблених).
+    """
+
+    progress = Signal(int)
+    enrolled = Signal(object, object, object, object)
+
+    def __init__(self, jobs, max_workers=None, parent=None):
+        super().__init__(parent)
+        self.jobs = jobs
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+
+    def run(self):
+        # Процеси запускаються через spawn, а не fork: у GUI-процесі вже працюють потоки Qt, запису,
+        # мініатюр і камер, і дочірній процес після fork міг би застрягнути на чужому блокуванні
+        pool = ProcessPoolExecutor(max_workers=min(self.max_workers, len(self.jobs)),
+                                   mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = {
+                pool.submit(encode_image_file, job["image_path"], job["digest"]): job
+                for job in self.jobs
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                if self.isInterruptionRequested():
+                    break
+                digest, encoding, error = future.result()
+                self.enrolled.emit(futures[future], digest, encoding, error)
+                self.progress.emit(done)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+# ------------------ ПАКЕТНЕ РОЗПІЗНАВАННЯ БЕЗ GUI ------------------
+
+# Стан процесу пулу пакетного розпізнавання (заповнюється init_recognition_worker)
+_recognition_worker = {}
+
+
+def init_recognition_worker(folder, detection_model, detection_resolution, tolerance):
+    """Ініціалізатор процесу пулу: кожен процес відкриває ту саму галерею (matrix через memmap)."""
+    _, gallery, _ = load_face_data(folder)
+    if len(gallery) >= ANN_MIN_GALLERY_SIZE and gallery.ann is None:
+        gallery.enable_ann()
+    _recognition_worker.update(
+        gallery=gallery,
+        detection_model=detection_model,
+        detection_resolution=detection_resolution,
+        tolerance=tolerance
+    )
+
+
+def recognize_rgb_image(rgb_image):
+    """
+    Знаходить і розпізнає всі обличчя на RGB-зображенні галереєю процесу пулу.
+    Повертає список {box [x, y, w, h], identity, id, distance} – по одному на обличчя.
+    """
+    state = _recognition_worker
+    resolution = state["detection_resolution"] or DetectionResolution.auto(rgb_image.shape[1])
+    analyzed = analyze_frame(rgb_image, state["detection_model"],
+                             detection_scale=resolution.scale_for(rgb_image.shape[1]))
+    matched_faces, distances = state["gallery"].match([encoding for _, encoding, _ in analyzed])
+    faces = []
+    for (bbox, _, _), face, distance in zip(analyzed, matched_faces, distances):
+        known = face is not None and distance <= state["tolerance"]
+        faces.append({
+            "box": [int(value) for value in bbox],
+            "identity": face.name if known else None,
+            "id": face.id if known else None,
+            "distance": round(float(distance), 4) if np.isfinite(distance) else None
+        })
+    return faces
+
+
+def recognize_image_file(image_path):
+    """
+    Виконується в пулі процесів: знаходить і розпізнає всі обличчя на зображенні.
+    Повертає записи для JSONL – по одному на обличчя (file, box [x, y, w, h], identity, distance).
+    """
+    try:
+        faces = recognize_rgb_image(face_recognition.load_image_file(image_path))
+    except Exception as e:
+        return [{"file": image_path, "error": str(e)}]
+
+    if not faces:
+        return [{"file": image_path, "box": None, "identity": None, "id": None, "distance": None}]
+    return [{"file": image_path, **face} for face in faces]
+
+
+def collect_image_files(patterns):
+    """Розгортає шляхи: тека – усі зображення в ній (рекурсивно), інакше – glob-шаблон або файл."""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+        else:
+            files.extend(path for path in sorted(glob.glob(pattern, recursive=True))
+                         if os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+    # Теки та шаблони можуть перетинатися – кожен файл обробляємо один раз
+    return list(dict.fromkeys(files))
+
+
+def run_batch_recognition(patterns, output, folder=FACE_DATA_FOLDER, workers=None, detection_model="hog",
+                          detection_resolution=None, tolerance=MATCH_TOLERANCE):
+    """
+    Розпізнає зображення з тек/шаблонів patterns у пулі процесів і одразу пише результати
+    в output як JSONL (рядок на обличчя, у порядку завершення). Підсумок – у stderr.
+    """
+    files = collect_image_files(patterns)
+    if not files:
+        print("Зображень не знайдено", file=sys.stderr)
+        return 1
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    face_count = 0
+    with multiprocessing.Pool(workers, initializer=init_recognition_worker,
+                              initargs=(folder, detection_model, detection_resolution, tolerance)) as pool:
+        for records in pool.imap_unordered(recognize_image_file, files, chunksize=4):
+            for record in records:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                face_count += record.get("box") is not None
+            output.flush()
+    elapsed = time.perf_counter() - start
+    print(f"Оброблено {len(files)} зображень, облич: {face_count}, {elapsed:.1f} с "
+          f"({len(files) / elapsed:.1f} зображень/с)", file=sys.stderr)
+    return 0
+
+# ------------------ ОБРОБКА ВІДЕОФАЙЛІВ ------------------
+
+def video_shards(frame_count, shard_count, stride):
+    """
+    Ділить кадри [0, frame_count) на shard_count діапазонів. Межі кратні stride,
+    тож вибрані кадри (кожен stride-й від початку відео) не залежать від поділу.
+    """
+    if frame_count <= 0:
+        # Кількість кадрів невідома (деякі контейнери) – обробляємо відео одним шматком
+        return [(0, sys.maxsize)]
+    step = -(-frame_count // max(shard_count, 1))
+    step = -(-step // stride) * stride
+    return [(start, min(start + step, frame_count)) for start in range(0, frame_count, step)]
+
+
+def process_video_shard(task):
+    """
+    Виконується в пулі процесів: розпізнає обличчя на кожному stride-му кадрі діапазону [start, end).
+    Проміжні кадри лише пропускаються через grab(), без перетворення в BGR.
+    """
+    video_path, start, end, stride = task
+    capture = cv2.VideoCapture(video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0
+    if start:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    frames = []
+    index = start
+    while index < end:
+        if index % stride:
+            if not capture.grab():
+                break
+        else:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            faces = recognize_rgb_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            frames.append({"frame": index, "time": round(index / fps, 3) if fps else None, "faces": faces})
+        index += 1
+    capture.release()
+    return frames
+
+
+def build_track_timeline(frames, stride, max_gap=2, iou_threshold=0.3):
+    """
+    Зшиває розпізнавання з вибраних кадрів у треки. Обличчя продовжує трек, якщо має ту саму
+    відому особу або стоїть на тому ж місці (IoU) і особи не суперечать одна одній; трек
+    закривається, якщо його не видно більше max_gap вибірок поспіль.
+    """
+    active, finished = [], []
+    for record in frames:
+        index = record["frame"]
+        still_active = []
+        for track in active:
+            (finished if index - track["end_frame"] > max_gap * stride else still_active).append(track)
+        active = still_active
+
+        for face in record["faces"]:
+            x, y, w, h = face["box"]
+            location = (y, x + w, y + h, x)
+            best, best_score = None, 0.0
+            for track in active:
+                if track["end_frame"] == index:
+                    continue
+                if face["identity"] is not None and face["identity"] == track["identity"]:
+                    score = 2.0
+                elif face["identity"] is None or track["identity"] is None:
+                    score = box_iou(location, track["location"])
+                    score = score if score >= iou_threshold else 0.0
+                else:
+                    score = 0.0
+                if score > best_score:
+                    best, best_score = track, score
+            if best is None:
+                best = {"track": len(active) + len(finished) + 1, "identity": None, "id": None,
+                        "start_frame": index, "start_time": record["time"], "end_frame": index,
+                        "end_time": record["time"], "samples": 0, "min_distance": None}
+                active.append(best)
+            if face["identity"] is not None:
+                best["identity"], best["id"] = face["identity"], face["id"]
+            if face["distance"] is not None and (best["min_distance"] is None or face["distance"] < best["min_distance"]):
+                best["min_distance"] = face["distance"]
+            best["end_frame"], best["end_time"] = index, record["time"]
+            best["location"] = location
+            best["samples"] += 1
+
+    tracks = sorted(finished + active, key=lambda track: (track["start_frame"], track["track"]))
+    for number, track in enumerate(tracks, 1):
+        track["track"] = number
+        del track["location"]
+    return tracks
+
+
+def run_video_recognition(video_path, output, folder=FACE_DATA_FOLDER, workers=None, stride=5, shards=None,
+                          timeline="frames", detection_model="hog", detection_resolution=None,
+                          tolerance=MATCH_TOLERANCE):
+    """
+    Офлайн-обробка відеофайлу: кадри діляться на діапазони, які паралельно обробляються в пулі процесів.
+    timeline="frames" – JSONL з рядком на кожен вибраний кадр (пишеться по мірі готовності, по порядку);
+    timeline="tracks" – JSONL з рядком на кожен трек (хто, з якого по який кадр).
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        print(f"Не вдалося відкрити відео: {video_path}", file=sys.stderr)
+        return 1
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0
+    capture.release()
+
+    workers = workers or os.cpu_count() or 1
+    # Кілька діапазонів на процес, щоб рівномірно завантажити пул
+    tasks = [(video_path, start, end, stride) for start, end in video_shards(frame_count, shards or 4 * workers, stride)]
+    start_time = time.perf_counter()
+    all_frames = []
+    with multiprocessing.Pool(workers, initializer=init_recognition_worker,
+                              initargs=(folder, detection_model, detection_resolution, tolerance)) as pool:
+        # imap повертає діапазони по порядку, тож кадри можна писати одразу
+        for done, frames in enumerate(pool.imap(process_video_shard, tasks), 1):
+            if timeline == "frames":
+                for record in frames:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+            else:
+                all_frames.extend(frames)
+            print(f"Оброблено діапазонів: {done}/{len(tasks)}", file=sys.stderr)
+
+    if timeline == "tracks":
+        for track in build_track_timeline(all_frames, stride):
+            output.write(json.dumps(track, ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - start_time
+    speed = f", {frame_count / fps / elapsed:.1f}x реального часу" if fps and frame_count > 0 else ""
+    print(f"Відео оброблено за {elapsed:.1f} с{speed}", file=sys.stderr)
+    return 0
+
+# ------------------ БЕНЧМАРК ЕТАПІВ ------------------
+
+BENCHMARK_SAMPLE_IMAGES = ("assets/Screenshot_1.png", "assets/Screenshot_2.png", "assets/Screenshot_3.png")
+BENCHMARK_RESOLUTIONS = ((640, 480), (1280, 720), (1920, 1080))
+
+
+def time_stage(stage, repeat=20, min_seconds=0.5):
+    """
+    Виконує stage() щонайменше repeat разів і не менше min_seconds секунд (після одного прогріву).
+    Повертає масив тривалостей викликів у мілісекундах.
+    """
+    stage()
+    durations = []
+    started = time.perf_counter()
+    while len(durations) < repeat or time.perf_counter() - started < min_seconds:
+        start = time.perf_counter()
+        stage()
+        durations.append((time.perf_counter() - start) * 1000)
+    return np.array(durations)
+
+
+def stage_result(stage, params, durations, items=1):
+    """Зводить тривалості етапу в перцентилі та пропускну здатність (items – оброблених об'єктів за виклик)."""
+    p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+    return {
+        "stage": stage,
+        "params": params,
+        "runs": len(durations),
+        "mean_ms": round(float(durations.mean()), 4),
+        "p50_ms": round(float(p50), 4),
+        "p90_ms": round(float(p90), 4),
+        "p99_ms": round(float(p99), 4),
+        "throughput_per_s": round(float(items * 1000 / durations.mean()), 2),
+    }
+
+
+def benchmark_face_crops(paths=BENCHMARK_SAMPLE_IMAGES):
+    """Вирізає обличчя з комплектних зображень (з полями) для складання синтетичних кадрів."""
+    crops = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        image = face_recognition.load_image_file(path)
+        for top, right, bottom, left in face_recognition.face_locations(image):
+            margin = (bottom - top) // 2
+            crops.append(image[max(top - margin, 0):bottom + margin, max(left - margin, 0):right + margin])
+    return crops
+
+
+def synthetic_frame(width, height, face_crops=(), face_count=0, seed=0):
+    """
+    Синтетичний кадр: шум і face_count облич із face_crops, розкладених сіткою.
+    Повертає BGR-кадр, як його віддає камера.
+    """
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    if face_count and face_crops:
+        columns = math.ceil(math.sqrt(face_count))
+        rows = math.ceil(face_count / columns)
+        cell_w, cell_h = width // columns, height // rows
+        for index in range(face_count):
+            crop = face_crops[index % len(face_crops)]
+            scale = min(cell_w / crop.shape[1], cell_h / crop.shape[0])
+            crop = cv2.resize(crop, (int(crop.shape[1] * scale), int(crop.shape[0] * scale)))
+            y = (index // columns) * cell_h
+            x = (index % columns) * cell_w
+            frame[y:y + crop.shape[0], x:x + crop.shape[1]] = crop[:, :, ::-1]
+    return frame
+
+
+def run_stage_benchmarks(output_path, resolutions=BENCHMARK_RESOLUTIONS, face_counts=(0, 1, 4),
+                         gallery_sizes=(100, 10000, 100000), models=("hog",), repeat=20, min_seconds=0.5):
+    """
+    Вимірює кожен етап конвеєра окремо: BGR->RGB, детекцію (hog/cnn), кодування, landmarks,
+    пошук у галереї, QImage/QPixmap і масштабування, малювання кадру у VideoWidget, малювання підписів. Кадри синтетичні,
+    обличчя беруться з комплектних зображень assets/. Результати записуються в JSON output_path
+    разом з версіями бібліотек, щоб порівнювати між версіями програми. Потрібен QApplication.
+    """
+    crops = benchmark_face_crops()
+    if not crops:
+        print("Не знайдено облич у комплектних зображеннях – етапи з обличчями буде пропущено")
+        face_counts = (0,)
+    results = []
+
+    def record(stage, params, stage_fn, items=1):
+        result = stage_result(stage, params, time_stage(stage_fn, repeat, min_seconds), items)
+        results.append(result)
+        print(f"{stage:>12} {json.dumps(params):<52} p50 {result['p50_ms']:>9.3f} ms  "
+              f"p99 {result['p99_ms']:>9.3f} ms  {result['throughput_per_s']:>10.1f}/s")
+
+    for width, height in resolutions:
+        for face_count in face_counts:
+            frame = synthetic_frame(width, height, crops, face_count)
+            params = {"width": width, "height": height, "faces": face_count}
+            record("bgr2rgb", params, lambda: cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+            locations = []
+            for model in models:
+                detection_scale = DetectionResolution.auto(width).scale_for(width)
+                record("detect", dict(params, model=model, scale=round(detection_scale, 3)),
+                       lambda: detect_faces(rgb_frame, model, detection_scale))
+                locations = detect_faces(rgb_frame, model, detection_scale)
+            if locations:
+                found = dict(params, detected=len(locations))
+                gate = FaceQualityGate()
+                record("quality", found, lambda: [gate.issue(rgb_frame, location, shape) for location, shape
+                                                  in zip(locations, face_shapes(rgb_frame, locations))],
+                       len(locations))
+                record("encode", found, lambda: analyze_faces(rgb_frame, locations), len(locations))
+                rects = [dlib.rectangle(left, top, right, bottom) for top, right, bottom, left in locations]
+                record("landmarks", found, lambda: [extract_landmarks(rgb_frame, rect) for rect in rects],
+                       len(rects))
+
+            bytes_per_line = 3 * width
+            record("qpixmap", params, lambda: QPixmap.fromImage(
+                QImage(rgb_frame.data, width, height, bytes_per_line, QImage.Format_RGB888)))
+            pixmap = QPixmap.fromImage(QImage(rgb_frame.data, width, height, bytes_per_line, QImage.Format_RGB888))
+            for target_width, target_height in ((1280, 720), (1920, 1080)):
+                for mode_name, mode in (("smooth", Qt.SmoothTransformation), ("fast", Qt.FastTransformation)):
+                    record("scale", dict(params, target=f"{target_width}x{target_height}", mode=mode_name),
+                           lambda: pixmap.scaled(target_width, target_height, Qt.KeepAspectRatio, mode))
+
+            # Шлях VideoWidget: QImage малюється одразу в цільовому розмірі, без QPixmap
+            bgra_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGRA)
+            record("rgb2bgra", params, lambda: cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGRA))
+            images = {
+                "rgb888": QImage(rgb_frame.data, width, height, bytes_per_line, QImage.Format_RGB888),
+                "rgb32": QImage(bgra_frame.data, width, height, 4 * width, QImage.Format_RGB32),
+            }
+            for target_width, target_height in ((1280, 720), (1920, 1080)):
+                canvas = QImage(target_width, target_height, QImage.Format_ARGB32_Premultiplied)
+                for source_format, image in images.items():
+                    for mode_name, smooth in (("smooth", True), ("fast", False)):
+                        def present():
+                            painter = QPainter(canvas)
+                            painter.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+                            painter.drawImage(QRect(0, 0, target_width, target_height), image)
+                            painter.end()
+                        record("present", dict(params, target=f"{target_width}x{target_height}", mode=mode_name,
+                                               source=source_format), present)
+
+            if locations:
+                _, landmarks = analyze_faces(rgb_frame, locations, with_landmarks=True)
+                overlay_faces = [{
+                    "bbox": (left, top, right - left, bottom - top),
+                    "face_id": index,
+                    "label": f"Person_{index}",
+                    "description": "Benchmark face\nsecond line",
+                    "landmarks": face_landmarks,
+                } for index, ((top, right, bottom, left), face_landmarks) in enumerate(zip(locations, landmarks))]
+                sprite_cache = OverlaySpriteCache()
+                for draw_landmarks in (False, True):
+                    for cache in (None, sprite_cache):
+                        def paint():
+                            canvas = QPixmap(pixmap)
+                            painter = QPainter(canvas)
+                            paint_face_overlays(painter, overlay_faces, 1.0, 1.0, draw_landmarks, cache)
+                            painter.end()
+                        record("overlay", dict(found, landmarks=draw_landmarks, sprites=cache is not None), paint,
+                               len(overlay_faces))
+
+    for size in gallery_sizes:
+        gallery = FaceGallery(capacity=size)
+        encodings = synthetic_encodings(size)
+        for face_id, encoding in enumerate(encodings):
+            gallery.add(FaceRecord(face_id, str(face_id)), encoding)
+        for face_count in (1, 8):
+            queries = encodings[:face_count] + np.float32(0.01)
+            record("match", {"gallery": size, "faces": face_count}, lambda: gallery.match(queries), face_count)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": sys.platform,
+        "cpu_count": os.cpu_count(),
+        "versions": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "dlib": dlib.__version__,
+            "face_recognition": getattr(face_recognition, "__version__", "unknown"),
+        },
+        "results": results,
+    }
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print("Результати збережено в", output_path)
+    return report
+
+
+def compare_stage_benchmarks(baseline_path, report):
+    """Друкує зміну p50 кожного етапу відносно попереднього файлу результатів."""
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    previous = {(item["stage"], json.dumps(item["params"], sort_keys=True)): item for item in baseline["results"]}
+    print(f"{'stage':>12} {'params':<52} {'before':>10} {'after':>10} {'change':>8}")
+    for item in report["results"]:
+        old = previous.get((item["stage"], json.dumps(item["params"], sort_keys=True)))
+        if old is None:
+            continue
+        change = item["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        print(f"{item['stage']:>12} {json.dumps(item['params']):<52} {old['p50_ms']:>10.3f} "
+              f"{item['p50_ms']:>10.3f} {change:>+8.0%}")
+
+
+# ------------------ ВІДОБРАЖЕННЯ ------------------
+
+# Оформлення підписів облич
+OVERLAY_COLOR = (0, 255, 0)
+OVERLAY_MARGIN = 8          # відступ від межі обличчя до блоку з текстом
+OVERLAY_PADDING = 4         # внутрішній відступ у блоці з текстом
+OVERLAY_BORDER_RADIUS = 10  # округлення кутів блоку
+
+
+def render_text_bubble(lines, font, device_pixel_ratio=1.0):
+    """Малює заокруглений блок з рядками тексту на прозорому QPixmap (спрайт для OverlaySpriteCache)."""
+    font_metrics = QFontMetrics(font)
+    line_height = font_metrics.height()
+    max_line_width = max(font_metrics.horizontalAdvance(line) for line in lines)
+    width = max_line_width + 2 * OVERLAY_PADDING
+    height = len(lines) * line_height + 2 * OVERLAY_PADDING
+
+    sprite = QPixmap(int(math.ceil(width * device_pixel_ratio)), int(math.ceil(height * device_pixel_ratio)))
+    sprite.setDevicePixelRatio(device_pixel_ratio)
+    sprite.fill(Qt.transparent)
+    painter = QPainter(sprite)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setFont(font)
+    painter.setPen(Qt.NoPen)
+    painter.setBrush(QColor(*OVERLAY_COLOR))
+    painter.drawRoundedRect(QRect(0, 0, width, height), OVERLAY_BORDER_RADIUS, OVERLAY_BORDER_RADIUS)
+    painter.setPen(Qt.black)
+    for index, line in enumerate(lines):
+        line_rect = QRect(OVERLAY_PADDING, OVERLAY_PADDING + index * line_height, max_line_width, line_height)
+        painter.drawText(line_rect, Qt.AlignLeft | Qt.AlignVCenter, line)
+    painter.end()
+    return sprite
+
+
+class OverlaySpriteCache:
+    """
+    LRU-кеш готових спрайтів підписів (ім'я та опис обличчя). Ключ – (id обличчя, текст, шрифт,
+    масштаб екрана), тож малювання підпису зводиться до одного drawPixmap. Після редагування
+    чи видалення обличчя його спрайти прибираються через invalidate(). Використовується лише в GUI-потоці.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._sprites = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def get(self, face_id, text, font, font_key, device_pixel_ratio=1.0):
+        key = (face_id, text, font_key, device_pixel_ratio)
+        sprite = self._sprites.get(key)
+        if sprite is not None:
+            self._sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+        self.misses += 1
+        sprite = render_text_bubble(text.splitlines() or [""], font, device_pixel_ratio)
+        self._sprites[key] = sprite
+        if len(self._sprites) > self.capacity:
+            self._sprites.popitem(last=False)
+        return sprite
+
+    def invalidate(self, face_id=None):
+        """Прибирає спрайти обличчя face_id (або всі, якщо face_id не задано)."""
+        if face_id is None:
+            self._sprites.clear()
+            return
+        for key in [key for key in self._sprites if key[0] == face_id]:
+            del self._sprites[key]
+
+
+def paint_face_overlays(painter, detected_faces, scale_x, scale_y, draw_landmarks=False, sprite_cache=None):
+    """
+    Малює рамки (або landmarks), імена та описи облич поверх кадру, масштабованого в scale_x/scale_y разів.
+    З sprite_cache підписи беруться з кешу спрайтів замість повторного вимірювання та малювання тексту.
+    """
+    if sprite_cache is not None:
+        font = painter.font()
+        font_key = font.key()
+        device_pixel_ratio = painter.device().devicePixelRatioF()
+
+    for face in detected_faces:
+        x, y, fw, fh = face["bbox"]
+        rx = int(x * scale_x)
+        ry = int(y * scale_y)
+        rfw = int(fw * scale_x)
+        rfh = int(fh * scale_y)
+
+        if draw_landmarks:
+            pen = QPen(QColor(*OVERLAY_COLOR), 2)
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            landmarks = face.get("landmarks", {})
+            for feature, points in landmarks.items():
+                for point in points:
+                    px = int(point[0] * scale_x)
+                    py = int(point[1] * scale_y)
+                    painter.drawEllipse(px - 2, py - 2, 4, 4)
+        else:
+            pen = QPen(QColor(*OVERLAY_COLOR))
+            pen.setWidth(2)
+            painter.setPen(pen)
+            # Пензель міг лишитися зеленим після підписів попереднього обличчя
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(rx, ry, rfw, rfh)
+
+        label_x = rx + OVERLAY_MARGIN
+        if sprite_cache is not None:
+            face_id = face.get("face_id")
+            label_sprite = sprite_cache.get(face_id, face["label"], font, font_key, device_pixel_ratio)
+            label_height = label_sprite.height() / label_sprite.devicePixelRatio()
+            # Нижня межа блоку з ім'ям на OVERLAY_MARGIN пікселів вище верхньої межі обличчя
+            painter.drawPixmap(label_x, int(max(ry - OVERLAY_MARGIN - label_height, 0)), label_sprite)
+            if face["description"]:
+                description_sprite = sprite_cache.get(face_id, face["description"], font, font_key,
+                                                      device_pixel_ratio)
+                painter.drawPixmap(label_x, ry + rfh + OVERLAY_MARGIN, description_sprite)
+            continue
+
+        fm = painter.fontMetrics()
+
+        # Рендеринг заголовка (ім'я) над обличчям:
+        label = face["label"]
+        label_width = fm.horizontalAdvance(label)
+        label_height = fm.height()
+
+        label_bg_width = label_width + 2 * OVERLAY_PADDING
+        label_bg_height = label_height + 2 * OVERLAY_PADDING
+        # Нижня межа блоку з ім'ям буде OVERLAY_MARGIN пікселів вище верхньої межі обличчя
+        label_bg_bottom = ry - OVERLAY_MARGIN
+        label_bg_top = max(label_bg_bottom - label_bg_height, 0)
+
+        label_background_rect = QRect(label_x, label_bg_top, label_bg_width, label_bg_height)
+
+        # Вмикаємо згладжування для кращої якості округлених кутів
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor(*OVERLAY_COLOR))
+        painter.drawRoundedRect(label_background_rect, OVERLAY_BORDER_RADIUS, OVERLAY_BORDER_RADIUS)
+        painter.setPen(Qt.black)
+
+        label_text_rect = QRect(
+            label_background_rect.left() + OVERLAY_PADDING,
+            label_background_rect.top() + OVERLAY_PADDING,
+            label_width,
+            label_height
+        )
+        painter.drawText(label_text_rect, Qt.AlignLeft | Qt.AlignVCenter, label)
+
+        # Рендеринг опису під обличчям:
+        if face["description"]:
+            description_lines = face["description"].splitlines()
+            max_line_width = max(fm.horizontalAdvance(line) for line in description_lines)
+            total_text_height = len(description_lines) * label_height
+
+            desc_bg_y = ry + rfh + OVERLAY_MARGIN
+            desc_bg_width = max_line_width + 2 * OVERLAY_PADDING
+            desc_bg_height = total_text_height + 2 * OVERLAY_PADDING
+
+            desc_background_rect = QRect(label_x, desc_bg_y, desc_bg_width, desc_bg_height)
+
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor(*OVERLAY_COLOR))
+            painter.drawRoundedRect(desc_background_rect, OVERLAY_BORDER_RADIUS, OVERLAY_BORDER_RADIUS)
+            painter.setPen(Qt.black)
+
+            for idx, line in enumerate(description_lines):
+                line_y = desc_background_rect.top() + OVERLAY_PADDING + idx * label_height
+                line_rect = QRect(
+                    desc_background_rect.left() + OVERLAY_PADDING,
+                    line_y,
+                    max_line_width,
+                    label_height
+                )
+                painter.drawText(line_rect, Qt.AlignLeft | Qt.AlignVCenter, line)
+
+
+def paint_text_panel(painter, lines, x=0, y=0):
+    """Малює рядки моноширинним шрифтом на напівпрозорій панелі з лівим верхнім кутом у (x, y)."""
+    painter.save()
+    painter.setFont(QFont("Monospace", 9))
+    fm = painter.fontMetrics()
+    padding = 6
+    width = max(fm.horizontalAdvance(line) for line in lines) + 2 * padding
+    height = len(lines) * fm.height() + 2 * padding
+    painter.setPen(Qt.NoPen)
+    painter.setBrush(QColor(0, 0, 0, 160))
+    painter.drawRect(x, y, width, height)
+    painter.setPen(QColor(0, 255, 0))
+    for index, line in enumerate(lines):
+        painter.drawText(x + padding, y + padding + index * fm.height() + fm.ascent(), line)
+    painter.restore()
+
+
+class VideoWidget(QWidget):
+    """
+    Віджет відео однієї камери. Кадр обгортається в QImage без копіювання і малюється в paintEvent
+    одразу в цільовому розмірі (з збереженням пропорцій), без проміжних QPixmap та масштабованих копій.
+    Підписи облич малюються поверх у координатах віджета. smooth_scaling вмикає білінійну
+    інтерполяцію, інакше використовується швидке масштабування найближчим сусідом.
+    """
+
+    def __init__(self, camera_index=0, metrics=None, smooth_scaling=False, sprite_cache=None, parent=None):
+        super().__init__(parent)
+        self.camera_index = camera_index
+        self.metrics = metrics
+        self.smooth_scaling = smooth_scaling
+        self.sprite_cache = sprite_cache
+        self.draw_landmarks = False
+        self.hud_lines = None
+        self.detected_faces = []
+        self._frame = None
+        self._image = None
+        # Розмір плитки задає сітка, а не поточний кадр; фон повністю замальовуємо самі
+        self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+
+    def set_frame(self, frame, detected_faces):
+        """
+        frame – RGB-кадр (h, w, 3) або кадр у форматі QImage.Format_RGB32 (h, w, 4), тобто BGRA.
+        RGB32 масштабується у кілька разів швидше, тому конвеєр готує його ще у фоновому потоці.
+        """
+        # QImage лише посилається на буфер масиву, тому тримаємо сам масив, поки кадр на екрані
+        self._frame = np.ascontiguousarray(frame)
+        h, w, ch = self._frame.shape
+        image_format = QImage.Format_RGB32 if ch == 4 else QImage.Format_RGB888
+        self._image = QImage(self._frame.data, w, h, ch * w, image_format)
+        self.detected_faces = detected_faces
+        self.update()
+
+    def frame_rect(self):
+        """Прямокутник у координатах віджета, в який вписано кадр."""
+        if self._image is None:
+            return QRect()
+        image_size = self._image.size().scaled(self.size(), Qt.KeepAspectRatio)
+        return QRect((self.width() - image_size.width()) // 2, (self.height() - image_size.height()) // 2,
+                     image_size.width(), image_size.height())
+
+    def paintEvent(self, event):
+        started = time.perf_counter()
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        if self._image is not None:
+            target = self.frame_rect()
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, self.smooth_scaling)
+            painter.drawImage(target, self._image)
+            painter.translate(target.topLeft())
+            paint_face_overlays(painter, self.detected_faces, target.width() / self._image.width(),
+                                target.height() / self._image.height(), self.draw_landmarks, self.sprite_cache)
+            painter.resetTransform()
+        if self.hud_lines:
+            paint_text_panel(painter, self.hud_lines)
+        painter.end()
+        if self.metrics is not None and self._image is not None:
+            self.metrics.observe("render", time.perf_counter() - started, self.camera_index)
+
+
+# ------------------ СПИСОК ЗБЕРЕЖЕНИХ ОБЛИЧ ------------------
+
+class ThumbnailLoader(QThread):
+    """
+    Фоновий потік, що декодує мініатюри облич. QImageReader одразу зменшує зображення під час
+    декодування (для JPEG це значно дешевше за повне декодування), тож повний кадр у пам'ять не потрапляє.
+    Запити обслуговуються від найновішого: під час прокручування спершу вантажаться видимі рядки,
+    а найстаріші запити понад max_pending відкидаються (модель попросить їх знову, коли рядок з'явиться).
+    """
+
+    loaded = Signal(object, object, object)  # id обличчя, версія, QImage
+
+    def __init__(self, thumbnail_size=48, max_pending=256, blob_source=None, parent=None):
+        super().__init__(parent)
+        self.thumbnail_size = thumbnail_size
+        self.max_pending = max_pending
+        # Необов'язкове джерело готових мініатюр: blob_source(id) -> JPEG (bytes) або None
+        self.blob_source = blob_source
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+
+    def request(self, face_id, image_path, version):
+        with self._cond:
+            self._pending.pop(face_id, None)
+            self._pending[face_id] = (image_path, version)
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+            self._cond.notify()
+
+    def stop(self):
+        self.requestInterruption()
+        with self._cond:
+            self._pending.clear()
+            self._cond.notify_all()
+        self.wait()
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(0.2)
+                    continue
+                face_id, (image_path, version) = self._pending.popitem(last=True)
+            blob = self.blob_source(face_id) if self.blob_source is not None else None
+            if blob:
+                image = QImage.fromData(blob).scaled(self.thumbnail_size, self.thumbnail_size, Qt.KeepAspectRatio,
+                                                     Qt.SmoothTransformation)
+            elif not image_path:
+                image = QImage()
+            else:
+                reader = QImageReader(image_path)
+                size = reader.size()
+                if size.isValid():
+                    reader.setScaledSize(size.scaled(self.thumbnail_size, self.thumbnail_size, Qt.KeepAspectRatio))
+                image = reader.read()
+            self.loaded.emit(face_id, version, image)
+
+
+class ThumbnailCache:
+    """LRU-кеш мініатюр (QPixmap) з обмеженою кількістю записів – пам'ять не залежить від розміру галереї."""
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self._pixmaps = OrderedDict()
+        self._versions = {}
+
+    def get(self, face_id):
+        pixmap = self._pixmaps.get(face_id)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(face_id)
+        return pixmap
+
+    def put(self, face_id, pixmap):
+        self._pixmaps[face_id] = pixmap
+        self._pixmaps.move_to_end(face_id)
+        while len(self._pixmaps) > self.capacity:
+            self._pixmaps.popitem(last=False)
+
+    def version(self, face_id):
+        return self._versions.get(face_id, 0)
+
+    def invalidate(self, face_id):
+        """Прибирає мініатюру; мініатюри попередніх версій, що ще декодуються, буде відкинуто."""
+        self._pixmaps.pop(face_id, None)
+        self._versions[face_id] = self.version(face_id) + 1
+
+
+class SavedFacesModel(QAbstractListModel):
+    """
+    Модель списку збережених облич поверх FaceRegistry. Рядки – лише id облич, а ім'я та мініатюра
+    беруться з реєстру на запит представлення, тож список на 100 тис. облич відкривається одразу.
+    Мініатюри декодуються у фоні (ThumbnailLoader) лише для рядків, які представлення показує;
+    thumbnail_source – необов'язкове джерело готових мініатюр (наприклад, SQLiteFaceStore.thumbnail).
+    """
+
+    FaceIdRole = Qt.UserRole + 1
+
+    def __init__(self, registry, thumbnail_size=48, cache_capacity=512, thumbnail_source=None, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        self._ids = [face.id for face in registry]
+        self._rows = {face_id: row for row, face_id in enumerate(self._ids)}
+        self.thumbnails = ThumbnailCache(cache_capacity)
+        self._placeholder = QPixmap(thumbnail_size, thumbnail_size)
+        self._placeholder.fill(Qt.transparent)
+        self.loader = ThumbnailLoader(thumbnail_size, blob_source=thumbnail_source)
+        self.loader.loaded.connect(self._on_thumbnail_loaded)
+        self.loader.start()
+
+    def set_registry(self, registry):
+        self.beginResetModel()
+        self.registry = registry
+        self._ids = [face.id for face in registry]
+        self._rows = {face_id: row for row, face_id in enumerate(self._ids)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._ids):
+            return None
+        face_id = self._ids[index.row()]
+        if role == self.FaceIdRole:
+            return face_id
+        face = self.registry.get(face_id)
+        if face is None:
+            return None
+        if role == Qt.DisplayRole:
+            return face.name
+        if role == Qt.ToolTipRole:
+            return face.description or None
+        if role == Qt.DecorationRole:
+            pixmap = self.thumbnails.get(face_id)
+            if pixmap is None:
+                if face.image_path or self.loader.blob_source is not None:
+                    self.loader.request(face_id, face.image_path, self.thumbnails.version(face_id))
+                return self._placeholder
+            return pixmap
+        return None
+
+    def face_at(self, row):
+        return self.registry.get(self._ids[row])
+
+    def add_face(self, face):
+        row = len(self._ids)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._ids.append(face.id)
+        self._rows[face.id] = row
+        self.endInsertRows()
+
+    def remove_face(self, face_id):
+        row = self._rows.pop(face_id, None)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._ids[row]
+        for shifted_row in range(row, len(self._ids)):
+            self._rows[self._ids[shifted_row]] = shifted_row
+        self.endRemoveRows()
+        self.thumbnails.invalidate(face_id)
+
+    def face_changed(self, face_id, image_changed=False):
+        """Оновлює рядок після редагування; image_changed – мініатюру треба декодувати заново."""
+        if image_changed:
+            self.thumbnails.invalidate(face_id)
+        row = self._rows.get(face_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def stop(self):
+        self.loader.stop()
+
+    def _on_thumbnail_loaded(self, face_id, version, image):
+        if version != self.thumbnails.version(face_id) or image.isNull():
+            return
+        self.thumbnails.put(face_id, QPixmap.fromImage(image))
+        row = self._rows.get(face_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
 # ------------------ ДІАЛОГОВІ ВІКНА ------------------
 
 class VideoSourceDialog(QDialog):
@@ -23,20 +3121,27 @@ class VideoSourceDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("Select Video Source")
         self.setModal(True)
-        self.setFixedSize(300, 150)
+        self.setFixedSize(300, 200)
 
         layout = QVBoxLayout(self)
 
         # Інструкція
-        label = QLabel("Enter a video source index (0 for default camera):")
+        label = QLabel("Enter video source indices (0 for default camera, comma-separated for several):")
+        label.setWordWrap(True)
         layout.addWidget(label)
 
-        # Поле вводу (приймає тільки цифри)
+        # Поле вводу (приймає тільки невід'ємні числа через кому)
         self.input_field = QLineEdit(self)
-        self.input_field.setPlaceholderText("0, 1, 2...")
-        self.input_field.setValidator(QIntValidator(0, 99, self))  # Дозволяє тільки невід'ємні числа
+        self.input_field.setPlaceholderText("0 or 0, 1, 2...")
+        self.input_field.setValidator(QRegularExpressionValidator(QRegularExpression(r"^\d{1,2}(\s*,\s*\d{1,2})*,?\s*$"), self))
         layout.addWidget(self.input_field)
 
+        # Роздільна здатність детекції: ширина в пікселях або масштаб, порожнє поле – автоматично
+        layout.addWidget(QLabel("Detection width or scale (empty for auto):"))
+        self.detection_field = QLineEdit(self)
+        self.detection_field.setPlaceholderText("auto, 640, 0.5...")
+        layout.addWidget(self.detection_field)
+
         # Кнопки "OK" і "Cancel"
         self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         self.button_box.accepted.connect(self.accept)
@@ -44,8 +3149,19 @@ class VideoSourceDialog(QDialog):
         layout.addWidget(self.button_box)
 
     def get_video_source(self):
-        text = self.input_field.text().strip()
-        return int(text) if text.isdigit() else None
+        sources = self.get_video_sources()
+        return sources[0] if sources else None
+
+    def get_video_sources(self):
+        """Повертає список індексів камер без повторів або порожній список, якщо введення некоректне."""
+        parts = [part.strip() for part in self.input_field.text().split(",") if part.strip()]
+        if not parts or not all(part.isdigit() for part in parts):
+            return []
+        return list(dict.fromkeys(int(part) for part in parts))
+
+    def get_detection_resolution(self):
+        """Повертає DetectionResolution або None для автоматичного вибору. ValueError – якщо значення некоректне."""
+        return DetectionResolution.parse(self.detection_field.text())
 
 class FaceInfoDialog(QDialog):
     """
@@ -182,6 +3298,7 @@ class AboutDialog(QDialog):
             "About (a) – Open this window\n"
             "Quit (q) – Exit the program\n"
             "(v) –Toggle face landmarks\n"
+            "(h) – Toggle pipeline metrics overlay\n"
         )
         hotkeys_label = QLabel(hotkeys_text)
         hotkeys_label.setWordWrap(True)
@@ -267,6 +3384,7 @@ class FaceDialog(QDialog):
         )
         if file_path:
             try:
+                wait_for_face_models()
                 image = face_recognition.load_image_file(file_path)
                 face_locations = face_recognition.face_locations(image, model="hog")
                 if not face_locations:
@@ -296,22 +3414,146 @@ class FaceDialog(QDialog):
     def getData(self):
         return (self.name_edit.text(), self.desc_edit.toPlainText(), self.face_pixmap, self.face_encoding)
 
+# ------------------ ЗАПУСК ------------------
+
+class StartupTimer:
+    """Тривалість етапів запуску; кожен етап одразу друкується разом з часом від старту процесу."""
+
+    def __init__(self):
+        self.phases = {}
+        self._last = time.perf_counter()
+
+    def phase(self, name, seconds=None):
+        """Завершує етап name; без seconds – етап головного потоку, що тривав від попереднього."""
+        now = time.perf_counter()
+        if seconds is None:
+            seconds = now - self._last
+            self._last = now
+        self.phases[name] = seconds
+        print(f"Запуск: {name} – {seconds:.2f} с (від старту {now - PROCESS_STARTED:.2f} с)")
+
+
+_face_models_lock = threading.Lock()
+_face_models_future = None
+
+
+def warm_up_face_models():
+    """
+    Завантажує моделі dlib (імпорт face_recognition) і проганяє детекцію, кодування та landmarks
+    на штучному кадрі, щоб перший кадр камери не платив за одноразову ініціалізацію.
+    """
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    face_recognition.face_locations(frame, model="hog")
+    analyze_faces(frame, [(60, 220, 180, 100)], with_landmarks=True)
+
+
+def start_face_model_warmup():
+    """Запускає warm_up_face_models у фоновому потоці (один раз на процес) і повертає його Future."""
+    global _face_models_future
+    with _face_models_lock:
+        if _face_models_future is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup")
+            _face_models_future = executor.submit(warm_up_face_models)
+            executor.shutdown(wait=False)
+        return _face_models_future
+
+
+def wait_for_face_models():
+    """Чекає, доки моделі завантажено (перше звернення до face_recognition лише з потоку прогріву)."""
+    start_face_model_warmup().result()
+
+
+def open_captures(sources, camera_options=None):
+    """
+    Відкриває камери паралельно як CameraCapture з параметрами camera_options (fourcc, size, fps,
+    buffer_size). Уже відкриті захоплення лише загортаються, без зміни формату.
+    """
+    sources = list(sources)
+    if not sources:
+        return []
+    cv2.VideoCapture  # модуль завантажується тут, до розпаралелювання (див. lazy_import)
+    open_camera = partial(CameraCapture, **(camera_options or {}))
+    with ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="camera") as pool:
+        return list(pool.map(open_camera, sources))
+
+
+class StartupWorker(QThread):
+    """
+    Виконує незалежні етапи запуску (завантаження моделей, відкриття камер, читання галереї)
+    паралельно в пулі потоків. Після кожного етапу – сигнал phase_finished з його тривалістю;
+    результати (або None, якщо етап упав) лежать у results, коли потік завершився (finished).
+    """
+
+    phase_finished = Signal(str, float)
+
+    def __init__(self, tasks, parent=None):
+        super().__init__(parent)
+        self.tasks = tasks
+        self.results = {}
+
+    @staticmethod
+    def _timed(task):
+        started = time.perf_counter()
+        return task(), time.perf_counter() - started
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=len(self.tasks), thread_name_prefix="startup") as pool:
+            futures = {pool.submit(self._timed, task): name for name, task in self.tasks.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    self.results[name], seconds = future.result()
+                except Exception as e:
+                    print(f"Помилка етапу запуску {name}: {e}")
+                    self.results[name], seconds = None, 0.0
+                self.phase_finished.emit(name, seconds)
+
 # ------------------ ГОЛОВНИЙ КЛАС ПРИЛОЖЕННЯ ------------------
 
 class FaceRecognitionApp(QMainWindow):
     # Нові константи – дані зберігаються в теці face_data, а JSON-файл face_data.json знаходиться всередині
-    FACE_DATA_FOLDER = "face_data"
-    FACE_DATA_FILE = os.path.join(FACE_DATA_FOLDER, "face_data.json")
-
-    def __init__(self):
+    FACE_DATA_FOLDER = FACE_DATA_FOLDER
+    FACE_DATA_FILE = os.path.join(FACE_DATA_FOLDER, FACE_DATA_FILE_NAME)
+    # Журнал змін після останнього знімка face_data.json (див. FaceDataWriter)
+    FACE_DATA_JOURNAL_FILE = os.path.join(FACE_DATA_FOLDER, FACE_DATA_JOURNAL_FILE_NAME)
+    FACE_DATABASE_FILE = os.path.join(FACE_DATA_FOLDER, FACE_DATABASE_FILE_NAME)
+    # Консолідована галерея: усі кодування в одній матриці + індекс рядків
+    GALLERY_MATRIX_FILE = os.path.join(FACE_DATA_FOLDER, GALLERY_MATRIX_FILE_NAME)
+    GALLERY_INDEX_FILE = os.path.join(FACE_DATA_FOLDER, GALLERY_INDEX_FILE_NAME)
+    # Приблизний індекс IVF для великих галерей (рядки відповідають GALLERY_MATRIX_FILE)
+    GALLERY_ANN_FILE = os.path.join(FACE_DATA_FOLDER, GALLERY_ANN_FILE_NAME)
+    # Розмір, час зміни та хеш кожного зареєстрованого зображення
+    ENROLL_MANIFEST_FILE = os.path.join(FACE_DATA_FOLDER, ENROLL_MANIFEST_FILE_NAME)
+
+    def __init__(self, captures, detection_resolution=None, metrics_file=None, metrics_interval=15.0,
+                 smooth_scaling=False, use_sqlite=False, startup=None, quality_gate=None, camera_options=None,
+                 latency_budget=0.25):
         super().__init__()
         self.setWindowTitle("Face Recognition System")
         self.showFullScreen()
 
-        self.unknown_faces = []
-        self.saved_faces = []
-        self.next_unknown_id = 1
+        # Нещодавно бачені невідомі обличчя (спільні для всіх камер)
+        self.unknown_faces = UnknownFaceStore()
+        self.registry = FaceRegistry()
+        # Захищає registry, unknown_faces та gallery, бо розпізнавання облич іде в окремому потоці
+        self.faces_lock = threading.RLock()
+        self.gallery = FaceGallery()
+        self.track_cache = TrackEncodingCache()
+        self.quality_gate = quality_gate if quality_gate is not None else FaceQualityGate()
         self.draw_landmarks = False
+        # Метрики конвеєра та HUD з ними поверх відео (клавіша H)
+        self.metrics = PipelineMetrics()
+        self.show_hud = False
+        # Готові спрайти підписів облич, спільні для всіх камер
+        self.overlay_sprites = OverlaySpriteCache()
+        # Останні розпізнані обличчя кожної камери для спільного списку LIST CURRENT
+        self.camera_faces = {}
+        # Сховище в одному файлі SQLite (None – face_data.json з теками облич); створена база
+        # використовується й надалі без прапорця --sqlite
+        self.face_store = None
+        if use_sqlite or os.path.exists(self.FACE_DATABASE_FILE):
+            os.makedirs(self.FACE_DATA_FOLDER, exist_ok=True)
+            self.face_store = SQLiteFaceStore(self.FACE_DATABASE_FILE)
 
         # --- Побудова графічного інтерфейсу ---
         main_widget = QWidget()
@@ -329,16 +3571,29 @@ class FaceRecognitionApp(QMainWindow):
         video_container.setLayout(QVBoxLayout())
         video_container.layout().setContentsMargins(0, 0, 0, 0)
 
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
-        scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        scroll_area.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-
-        self.video_label = QLabel()
-        self.video_label.setAlignment(Qt.AlignCenter)
-        scroll_area.setWidget(self.video_label)
-
-        video_container.layout().addWidget(scroll_area)
+        # Сітка відео: по плитці (підпис + зображення) на кожну камеру
+        video_grid_widget = QWidget()
+        video_grid = QGridLayout(video_grid_widget)
+        video_grid.setContentsMargins(0, 0, 0, 0)
+        video_grid.setSpacing(2)
+        columns = max(1, math.ceil(math.sqrt(len(captures))))
+        self.video_widgets = []
+        self.camera_captions = []
+        for camera_index in range(len(captures)):
+            tile = QWidget()
+            tile_layout = QVBoxLayout(tile)
+            tile_layout.setContentsMargins(0, 0, 0, 0)
+            tile_layout.setSpacing(0)
+            caption = QLabel(f"Cam {camera_index}")
+            caption.setVisible(len(captures) > 1)
+            video_widget = VideoWidget(camera_index, self.metrics, smooth_scaling, self.overlay_sprites)
+            tile_layout.addWidget(caption)
+            tile_layout.addWidget(video_widget, stretch=1)
+            video_grid.addWidget(tile, camera_index // columns, camera_index % columns)
+            self.video_widgets.append(video_widget)
+            self.camera_captions.append(caption)
+
+        video_container.layout().addWidget(video_grid_widget)
         left_layout.addWidget(video_container, stretch=1)
 
         bottom_panel = QWidget()
@@ -362,7 +3617,26 @@ class FaceRecognitionApp(QMainWindow):
         right_layout.addWidget(self.current_list)
 
         right_layout.addWidget(QLabel("ALL SAVED"))
-        self.saved_list = QListWidget()
+        self.saved_search = QLineEdit()
+        self.saved_search.setPlaceholderText("Search...")
+        self.saved_search.setClearButtonEnabled(True)
+        right_layout.addWidget(self.saved_search)
+        # Список збережених облич – модель поверх реєстру з фільтром за іменем і ледачими мініатюрами
+        self.saved_model = SavedFacesModel(
+            self.registry, thumbnail_source=self.face_store.thumbnail if self.face_store is not None else None,
+            parent=self)
+        self.saved_proxy = QSortFilterProxyModel(self)
+        self.saved_proxy.setSourceModel(self.saved_model)
+        self.saved_proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.saved_search.textChanged.connect(self.saved_proxy.setFilterFixedString)
+        self.saved_list = QListView()
+        self.saved_list.setModel(self.saved_proxy)
+        self.saved_list.setUniformItemSizes(True)
+        # Розкладка порціями, щоб велика галерея не блокувала показ вікна
+        self.saved_list.setLayoutMode(QListView.Batched)
+        self.saved_list.setBatchSize(2000)
+        self.saved_list.setIconSize(QSize(48, 48))
+        self.saved_list.setSelectionMode(QListView.SingleSelection)
         right_layout.addWidget(self.saved_list)
 
         info_edit_layout = QHBoxLayout()
@@ -409,139 +3683,337 @@ class FaceRecognitionApp(QMainWindow):
         self.shortcut_quit = QShortcut(QKeySequence(Qt.Key_Q), self)
         self.shortcut_quit.activated.connect(self.quit_btn.click)
 
+        # Прогрес фонової реєстрації облич з теки face_data
+        self.enroll_progress = QProgressBar()
+        self.enroll_progress.setFormat("Enrolling faces: %v/%m")
+        self.enroll_progress.hide()
+        self.statusBar().addPermanentWidget(self.enroll_progress)
+        # Рівень зниження якості під навантаженням (LoadShedder) для кожної камери
+        self.latency_budget = latency_budget
+        self.load_label = QLabel()
+        self.statusBar().addPermanentWidget(self.load_label)
+        self.enrollment_worker = None
+        self.enroll_manifest = {}
+
+        # Увесь запис на диск (зображення, кодування, журнал, знімок або рядки бази) іде у фоновому потоці
+        if self.face_store is not None:
+            self.face_writer = FaceDataWriter(parent=self)
+        else:
+            self.face_writer = FaceDataWriter(self.FACE_DATA_JOURNAL_FILE, self.write_snapshot, parent=self)
+        self.face_writer.image_saved.connect(self.on_face_image_saved)
+        self.face_writer.journaled.connect(self.on_changes_journaled)
+
         # --- Завантаження даних та налаштування відеопотоку ---
-        self.load_saved_faces()
+        # Вікно вже показано; моделі, камери та галерея готуються паралельно у фоні,
+        # а конвеєри стартують, коли всі етапи завершено (on_startup_finished)
+        self.startup = startup if startup is not None else StartupTimer()
+        self.detection_resolution = detection_resolution
+        self.gallery_file_stale = False
+        self.captures = []
+        self.pipelines = []
+        # Детекція та розпізнавання працюють у фонових потоках, GUI лише малює готові кадри.
+        # Усі камери ділять одну галерею та один пул потоків детекції.
+        self.detector_pool = DetectorPool()
+        self.first_frame_shown = False
+        self.statusBar().showMessage("Loading face models...")
+        self.startup_worker = StartupWorker({
+            "face models": wait_for_face_models,
+            "cameras": partial(open_captures, captures, camera_options),
+            "gallery": self.read_saved_faces
+        }, parent=self)
+        self.startup_worker.phase_finished.connect(self.startup.phase)
+        self.startup_worker.finished.connect(self.on_startup_finished)
+        self.startup_worker.start()
+
+        # Періодичний запис метрик для node_exporter (textfile collector) або у JSON
+        self.metrics_file = metrics_file
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.export_metrics)
+        if metrics_file:
+            self.metrics_timer.start(int(metrics_interval * 1000))
+
+    def on_startup_finished(self):
+        """Слот StartupWorker.finished: застосовує прочитану галерею та запускає конвеєри камер."""
+        results = self.startup_worker.results
+        saved = results.get("gallery")
+        if saved is not None:
+            registry, gallery, imported = saved
+            with self.faces_lock:
+                self.registry, self.gallery = registry, gallery
+            self.gallery_file_stale = imported
+            self.saved_model.set_registry(self.registry)
+            self.face_writer.snapshot_size = len(registry)
+        self.face_writer.start()
+        self.update_ann_index()
         self.scan_face_data_folder()
+        if self.gallery_file_stale:
+            self.face_writer.compact()
 
         # Якщо теки face_data немає – створюємо її
         if not os.path.exists(self.FACE_DATA_FOLDER):
             os.makedirs(self.FACE_DATA_FOLDER)
 
-        self.capture = video_capture_source
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
-        self.timer.start(30)  # приблизно 33 fps
-
-        self.detection_model = "hog"
+        self.captures = results.get("cameras") or []
+        for camera_index, capture in enumerate(self.captures):
+            pipeline = RecognitionPipeline(camera_index, capture, self.identify_faces, self.detector_pool,
+                                           self.detection_resolution, self.metrics,
+                                           LoadShedder(self.latency_budget), parent=self)
+            print(f"Камера {camera_index}: формат {capture}, роздільна здатність детекції "
+                  f"{pipeline.detection_resolution}")
+            pipeline.frame_ready.connect(self.render_frame)
+            pipeline.load_level_changed.connect(self.on_load_level_changed)
+            self.pipelines.append(pipeline)
+        self.update_load_label()
+        self.detector_pool.start()
+        for pipeline in self.pipelines:
+            pipeline.start()
+        self.statusBar().clearMessage()
+        self.startup.phase("pipelines started")
 
     def show_about(self):
         dlg = AboutDialog(self)
         dlg.exec()
 
-    def show_info(self):
-        selected_items = self.saved_list.selectedItems()
-        if not selected_items:
-            return
-        item = selected_items[0]
-        face = next((f for f in self.saved_faces if f["name"] == item.text()), None)
-        if face is None:
-            return
-
-        if face["pixmap"] is None and os.path.exists(face["image_path"]):
-            face["pixmap"] = QPixmap(face["image_path"])
+    def selected_saved_face(self):
+        """Обличчя, вибране у списку ALL SAVED, або None."""
+        indexes = self.saved_list.selectionModel().selectedIndexes()
+        if not indexes:
+            return None
+        return self.registry.get(indexes[0].data(SavedFacesModel.FaceIdRole))
+
+    def _load_face_pixmap(self, face):
+        """Повне зображення обличчя для діалогів; у записі не зберігається, щоб не тримати його в пам'яті."""
+        if face.pixmap is not None:
+            return face.pixmap
+        pending = self.face_writer.pending_image(face.id)
+        if pending is not None:
+            return QPixmap.fromImage(pending)
+        if self.face_store is not None and not face.image_path:
+            pixmap = QPixmap()
+            pixmap.loadFromData(self.face_store.image(face.id) or b"")
+            return pixmap
+        if os.path.exists(face.image_path):
+            return QPixmap(face.image_path)
+        return QPixmap()
+
+    def _name_is_free(self, name, face=None):
+        """
+        Чи можна дати обличчю face ім'я name. Ім'я визначає теку та файли обличчя, тож дублікат
+        перезаписав би дані іншої людини – у такому разі показуємо попередження і повертаємо False.
+        """
+        with self.faces_lock:
+            owner = self.registry.get_by_name(name)
+        if owner is None or owner is face:
+            return True
+        QMessageBox.warning(self, "Error", f"A face named '{name}' already exists. Please choose another name.")
+        return False
 
     def show_info(self):
-        selected_items = self.saved_list.selectedItems()
-        if not selected_items:
-            return
-        item = selected_items[0]
-        face = next((f for f in self.saved_faces if f["name"] == item.text()), None)
+        face = self.selected_saved_face()
         if face is None:
             return
 
-        # Завантажуємо pixmap, якщо ще не завантажений
-        if face["pixmap"] is None and os.path.exists(face["image_path"]):
-            face["pixmap"] = QPixmap(face["image_path"])
+        if face.encoding is None:
+            face.encoding = self.gallery.encoding(face.id)
 
+        face_pixmap = self._load_face_pixmap(face)
         dlg = FaceInfoDialog(
-            face_pixmap=face["pixmap"] if face["pixmap"] else QPixmap(),
-            name=face["name"],
-            description=face["description"],
-            encoding=face.get("encoding", None),
+            face_pixmap=face_pixmap,
+            name=face.name,
+            description=face.description,
+            encoding=face.encoding,
             parent=self
         )
         dlg.exec()
 
-        # Після закриття діалогу перевіряємо, чи оновилися дані (користувач міг натиснути 'e' і зберегти зміни)
-        updated_name = dlg.name
-        updated_desc = dlg.description
-        updated_pixmap = dlg.face_pixmap
-        updated_encoding = dlg.encoding
-
-        # Якщо ім'я змінилося, треба перейменувати теку, оновити saved_faces тощо
-        if updated_name != face["name"]:
-            old_folder = os.path.join(self.FACE_DATA_FOLDER, face["name"])
-            new_folder = os.path.join(self.FACE_DATA_FOLDER, updated_name)
-            if os.path.exists(old_folder):
-                os.rename(old_folder, new_folder)
-            face["name"] = updated_name
-            face["image_path"] = os.path.join(new_folder, f"{updated_name}.jpg")
-            face["encoding_path"] = os.path.join(new_folder, f"{updated_name}.npy")
-            # Оновлюємо назву в QListWidget:
-            item.setText(updated_name)
-
-        face["description"] = updated_desc
-        face["pixmap"] = updated_pixmap
-        face["encoding"] = updated_encoding
-
-        # Зберігаємо зміни у файли, якщо треба
-        if face["pixmap"] and not face["pixmap"].isNull():
-            face["pixmap"].save(face["image_path"], "JPG")
-        if face["encoding"] is not None:
-            np.save(face["encoding_path"], face["encoding"])
-        
-        # Можливо, викличемо метод збереження JSON:
-        self.save_saved_faces()
-
-
-
-    def load_saved_faces(self):
-        """Завантаження метаданих з JSON-файлу."""
+        # Після закриття діалогу перевіряємо, чи оновилися дані (користувач міг натиснути 'e' і зберегти зміни).
+        # Діалог редагування повертає ті самі об'єкти зображення та кодування, якщо їх не змінювали
+        renamed = dlg.name != face.name
+        image_changed = dlg.face_pixmap is not face_pixmap
+        encoding_changed = dlg.encoding is not face.encoding
+        if not (renamed or image_changed or encoding_changed or dlg.description != face.description):
+            return
+
+        # Якщо ім'я змінилося, треба перейменувати теку, оновити реєстр тощо
+        old_name = face.name
+        if renamed:
+            if not self._name_is_free(dlg.name, face):
+                return
+            with self.faces_lock:
+                self.registry.rename(face, dlg.name)
+
+        face.description = dlg.description
+        face.encoding = dlg.encoding
+        if encoding_changed:
+            with self.faces_lock:
+                self.gallery.add(face, face.encoding)
+        self.overlay_sprites.invalidate(face.id)
+
+        # Зберігаємо зміни (у фоні). Файли обличчя названо за ім'ям, тож після перейменування
+        # зображення та кодування записуються наново
+        image = None
+        if (renamed or image_changed) and dlg.face_pixmap and not dlg.face_pixmap.isNull():
+            image = dlg.face_pixmap.toImage()
+        encoding = face.encoding if renamed or encoding_changed else None
+        self._persist_face(face, encoding, image, old_name if renamed else None)
+        self.saved_model.face_changed(face.id, image_changed=image_changed)
+
+
+
+    def read_saved_faces(self):
+        """
+        Читає галерею з бази SQLite або з JSON-файлу та журналу змін. Етап запуску: виконується
+        у фоновому потоці StartupWorker і стан вікна не змінює. Повертає (registry, gallery, imported)
+        або None, якщо збережених облич немає.
+        """
         if not os.path.exists(self.FACE_DATA_FOLDER):
             os.makedirs(self.FACE_DATA_FOLDER)
-            return
-        if os.path.exists(self.FACE_DATA_FILE):
+            return None
+        if self.face_store is not None:
+            try:
+                if len(self.face_store) == 0 and (os.path.exists(self.FACE_DATA_FILE)
+                                                  or os.path.exists(self.FACE_DATA_JOURNAL_FILE)):
+                    registry, gallery, _ = load_face_files(self.FACE_DATA_FOLDER)
+                    self.face_store.import_faces(registry, gallery)
+                    print(f"Перенесено в {self.FACE_DATABASE_FILE} облич: {len(registry)}")
+                registry, gallery = self.face_store.load()
+                return registry, gallery, False
+            except Exception as e:
+                print("Помилка завантаження бази облич:", e)
+            return None
+        if os.path.exists(self.FACE_DATA_FILE) or os.path.exists(self.FACE_DATA_JOURNAL_FILE):
             try:
-                with open(self.FACE_DATA_FILE, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                for face in data:
-                    face["encoding"] = None
-                    face["pixmap"] = None
-                    self.saved_faces.append(face)
-                    self.saved_list.addItem(face["name"])
+                return load_face_files(self.FACE_DATA_FOLDER)
             except Exception as e:
                 print("Помилка завантаження збережених облич:", e)
+        return None
 
-    def save_saved_faces(self):
-        try:
-            data = []
-            for face in self.saved_faces:
-                data.append({
-                    "id": face["id"],
-                    "name": face["name"],
-                    "description": face["description"],
-                    "image_path": face.get("image_path", ""),
-                    "encoding_path": face.get("encoding_path", "")
-                })
-            with open(self.FACE_DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            print("Помилка збереження облич:", e)
+    def write_snapshot(self):
+        """
+        Знімок для стиснення журналу; виконується в потоці FaceDataWriter.
+        Під блокуванням лише копіюються дані, запис face_data.json і матриці йде вже без нього.
+        Повертає кількість облич у знімку.
+        """
+        with self.faces_lock:
+            data = [face.to_json() for face in self.registry]
+            gallery_snapshot = self.gallery.snapshot()
+        write_json_atomic(self.FACE_DATA_FILE, data)
+        self.gallery.save(self.GALLERY_MATRIX_FILE, self.GALLERY_INDEX_FILE, gallery_snapshot, self.GALLERY_ANN_FILE)
+        self.gallery_file_stale = False
+        return len(data)
+
+    def _persist_face(self, face, encoding=None, image=None, old_name=None):
+        """
+        Зберігає у фоні зміну обличчя: encoding – нове кодування, image – нове зображення (QImage),
+        old_name – попереднє ім'я, якщо тека обличчя мала б перейменуватися.
+        Файлове сховище: тека <ім'я> з <ім'я>.jpg/.npy плюс запис журналу.
+        SQLite: одна транзакція з рядком обличчя; тека, з якої взято зображення, більше не потрібна.
+        """
+        folder = os.path.join(self.FACE_DATA_FOLDER, face.name)
+        if old_name == face.name:
+            old_name = None
+        if self.face_store is not None:
+            old_folder = os.path.join(self.FACE_DATA_FOLDER, old_name or face.name)
+            obsolete_folder = None
+            if image is not None:
+                if face.image_path and os.path.dirname(face.image_path) == old_folder:
+                    obsolete_folder = old_folder
+                face.image_path = ""
+            face.encoding_path = ""
+            store_row = partial(self._store_face_row, face.to_json(), encoding, obsolete_folder)
+            if image is not None:
+                self.face_writer.save_image(face.id, image, store_row)
+            else:
+                self.face_writer.submit(store_row)
+            return
+
+        if image is not None or old_name is not None:
+            face.image_path = os.path.join(folder, f"{face.name}.jpg")
+            face.encoding_path = os.path.join(folder, f"{face.name}.npy")
+            # Без зміни імені лише переконуємося, що тека є
+            self.face_writer.submit(prepare_face_folder, os.path.join(self.FACE_DATA_FOLDER, old_name or face.name),
+                                    folder)
+        if image is not None:
+            self.face_writer.save_image(face.id, image, partial(save_jpeg, face.image_path))
+        if encoding is not None:
+            self.face_writer.submit(np.save, face.encoding_path, encoding)
+        self.face_writer.journal(journal_put_record(face, encoding))
+
+    def _store_face_row(self, data, encoding, obsolete_folder, image=None):
+        """Задача FaceDataWriter для SQLite: транзакція з рядком обличчя, потім прибирання старої теки."""
+        self.face_store.put(data, encoding, image)
+        if obsolete_folder is not None:
+            remove_face_folder(obsolete_folder)
+
+    def _forget_face(self, face):
+        """Видаляє збережене обличчя з диска у фоні (тека та запис журналу або рядок бази)."""
+        face_folder = os.path.join(self.FACE_DATA_FOLDER, face.name)
+        if self.face_store is not None:
+            self.face_writer.submit(self.face_store.delete, face.id)
+        else:
+            self.face_writer.journal(journal_delete_record(face.id))
+        self.face_writer.submit(remove_face_folder, face_folder)
+
+    def on_face_image_saved(self, face_id):
+        """Слот FaceDataWriter.image_saved: мініатюру треба декодувати з нового файлу."""
+        self.saved_model.face_changed(face_id, image_changed=True)
+
+    def on_changes_journaled(self, count):
+        """Слот FaceDataWriter.journaled: зміни вже на диску."""
+        self.statusBar().showMessage("Changes saved", 2000)
+
+    def update_ann_index(self):
+        """
+        Вмикає приблизний пошук (IVFIndex), коли галерея досягає ANN_MIN_GALLERY_SIZE облич.
+        Індекс з GALLERY_ANN_FILE завантажується разом з галереєю (load_face_files); якщо його немає
+        або галерея з часу навчання виросла в кілька разів – навчається заново.
+        """
+        with self.faces_lock:
+            if len(self.gallery) < ANN_MIN_GALLERY_SIZE:
+                self.gallery.ann = None
+                return
+            ann = self.gallery.ann
+            if ann is None or len(self.gallery) > 4 * ann.trained_size:
+                print(f"Побудова індексу IVF для {len(self.gallery)} облич...")
+                self.gallery.enable_ann()
+                self.gallery_file_stale = True
 
     def scan_face_data_folder(self):
         """
         Скануємо теку FACE_DATA_FOLDER. Якщо користувач додав зображення безпосередньо в цю теку,
-        створюємо для нього окрему папку (назва за іменем файлу), переміщаємо зображення, обчислюємо кодування та додаємо дані у saved_faces.
+        створюємо для нього окрему папку (назва за іменем файлу), переміщаємо зображення, обчислюємо кодування та додаємо обличчя в реєстр.
         Також обробляємо вже існуючі підпапки.
+        Кодування обчислюються у фоні пулом процесів (EnrollmentWorker), прогрес видно в рядку стану.
+        Маніфест ENROLL_MANIFEST_FILE зберігає розмір, час зміни та хеш кожного зображення,
+        тож при наступних запусках перераховуються лише нові або змінені зображення.
         """
         if not os.path.exists(self.FACE_DATA_FOLDER):
             os.makedirs(self.FACE_DATA_FOLDER)
             return
 
+        self.enroll_manifest = self._load_enroll_manifest()
+        # Імена облич, для яких уже поставлено завдання реєстрації (їх ще немає в реєстрі)
+        pending_names = set()
+        jobs = []
+
+        # Відомі обличчя перераховуємо лише тоді, коли їхнє зображення змінилося
+        for face in self.registry:
+            image_path = face.image_path
+            if not os.path.exists(image_path):
+                continue
+            current = self._is_enrollment_current(image_path)
+            if current is None and face.id in self.gallery:
+                # Обличчя з часів до маніфесту: вважаємо кодування актуальним
+                self._update_enroll_manifest(image_path, None)
+            elif current is False:
+                jobs.append(self._enrollment_job(face.name, image_path, face))
+
         for entry in os.listdir(self.FACE_DATA_FOLDER):
             entry_path = os.path.join(self.FACE_DATA_FOLDER, entry)
             if os.path.isdir(entry_path):
-                # Підпапка – вважаємо, що це обличчя
+                # Підпапка – вважаємо, що це обличчя. Відомі обличчя вже в галереї, файли не читаємо
+                if self.registry.has_name(entry) or entry in pending_names:
+                    continue
                 image_file = None
                 npy_file = None
                 for file in os.listdir(entry_path):
@@ -551,41 +4023,27 @@ class FaceRecognitionApp(QMainWindow):
                         image_file = file_path
                     elif ext == ".npy":
                         npy_file = file_path
-                if image_file:
-                    if not npy_file:
-                        try:
-                            image = face_recognition.load_image_file(image_file)
-                            encodings = face_recognition.face_encodings(image)
-                            if not encodings:
-                                print(f"Обличчя не знайдено на зображенні: {image_file}")
-                                continue
-                            encoding = encodings[0]
-                            npy_file = os.path.join(entry_path, f"{entry}.npy")
-                            np.save(npy_file, encoding)
-                            print(f"Кодування створено для {image_file}")
-                        except Exception as e:
-                            print(f"Помилка створення кодування для {image_file}: {e}")
-                            continue
-                    else:
-                        encoding = np.load(npy_file)
-                    pixmap = QPixmap(image_file)
-                    face_entry = {
-                        "id": self._get_next_id(),
-                        "name": entry,
-                        "description": "",
-                        "image_path": image_file,
-                        "encoding_path": npy_file,
-                        "encoding": encoding,
-                        "pixmap": pixmap
-                    }
-                    if not any(f["name"] == entry for f in self.saved_faces):
-                        self.saved_faces.append(face_entry)
-                        self.saved_list.addItem(entry)
+                if not image_file:
+                    continue
+                pending_names.add(entry)
+                if npy_file and self._is_enrollment_current(image_file) is not False:
+                    encoding = np.load(npy_file)
+                    self._update_enroll_manifest(image_file, None)
+                    face_entry = self.registry.add(self._new_face_entry(entry, image_file, npy_file, encoding))
+                    self.gallery.add(face_entry, encoding)
+                    self._persist_face(face_entry, encoding)
+                    self.gallery_file_stale = True
+                    self.saved_model.add_face(face_entry)
+                else:
+                    jobs.append(self._enrollment_job(entry, image_file))
             elif os.path.isfile(entry_path):
                 # Якщо файл – перевіряємо чи це зображення (але не JSON)
                 ext = os.path.splitext(entry)[1].lower()
                 if ext in IMAGE_EXTENSIONS and entry.lower() != "face_data.json":
                     face_name = os.path.splitext(entry)[0]
+                    if self.registry.has_name(face_name) or face_name in pending_names:
+                        print(f"Обличчя з іменем {face_name} вже існує, пропускаємо {entry_path}")
+                        continue
                     face_folder = os.path.join(self.FACE_DATA_FOLDER, face_name)
                     if not os.path.exists(face_folder):
                         os.makedirs(face_folder)
@@ -595,237 +4053,305 @@ class FaceRecognitionApp(QMainWindow):
                     except Exception as e:
                         print(f"Не вдалося перемістити зображення {entry_path}: {e}")
                         continue
-                    try:
-                        image = face_recognition.load_image_file(new_image_path)
-                        encodings = face_recognition.face_encodings(image)
-                        if not encodings:
-                            print(f"Обличчя не знайдено на зображенні: {new_image_path}")
-                            continue
-                        encoding = encodings[0]
-                        npy_file = os.path.join(face_folder, f"{face_name}.npy")
-                        np.save(npy_file, encoding)
-                        print(f"Кодування створено для {new_image_path}")
-                        pixmap = QPixmap(new_image_path)
-                        face_entry = {
-                            "id": self._get_next_id(),
-                            "name": face_name,
-                            "description": "",
-                            "image_path": new_image_path,
-                            "encoding_path": npy_file,
-                            "encoding": encoding,
-                            "pixmap": pixmap
-                        }
-                        if not any(f["name"] == face_name for f in self.saved_faces):
-                            self.saved_faces.append(face_entry)
-                            self.saved_list.addItem(face_name)
-                    except Exception as e:
-                        print(f"Помилка обробки зображення {new_image_path}: {e}")
-                        continue
-
-    def _get_next_id(self):
-        if not self.saved_faces:
-            return 1
-        return max(face["id"] for face in self.saved_faces) + 1
-
-    def update_frame(self):
-        ret, frame = self.capture.read()
-        if not ret:
+                    pending_names.add(face_name)
+                    jobs.append(self._enrollment_job(face_name, new_image_path))
+
+        if jobs:
+            self.start_enrollment(jobs)
+
+    def _enrollment_job(self, name, image_path, face=None):
+        entry = self.enroll_manifest.get(self._manifest_key(image_path), {})
+        return {
+            "name": name,
+            "image_path": image_path,
+            "encoding_path": os.path.join(os.path.dirname(image_path), f"{name}.npy"),
+            "face": face,
+            "digest": entry.get("sha1")
+        }
+
+    def _new_face_entry(self, name, image_path, encoding_path, encoding):
+        return FaceRecord(self.registry.allocate_id(), name, "", image_path, encoding_path, encoding)
+
+    def start_enrollment(self, jobs):
+        self.enroll_progress.setRange(0, len(jobs))
+        self.enroll_progress.setValue(0)
+        self.enroll_progress.show()
+        self.enrollment_worker = EnrollmentWorker(jobs, parent=self)
+        self.enrollment_worker.progress.connect(self.enroll_progress.setValue)
+        self.enrollment_worker.enrolled.connect(self.on_face_enrolled)
+        self.enrollment_worker.finished.connect(self.on_enrollment_finished)
+        self.enrollment_worker.start()
+
+    def on_face_enrolled(self, job, digest, encoding, error):
+        """Слот EnrollmentWorker.enrolled: додає або оновлює обличчя за результатом з пулу процесів."""
+        image_path = job["image_path"]
+        if error:
+            print(f"Помилка створення кодування для {image_path}: {error}")
+            return
+        if encoding is None:
+            if digest == job["digest"]:
+                # Змінився лише час модифікації, вміст той самий – кодування актуальне
+                self._update_enroll_manifest(image_path, digest)
+            else:
+                print(f"Обличчя не знайдено на зображенні: {image_path}")
             return
 
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_frame, model=self.detection_model)
-
-        for face in self.unknown_faces:
-            face["detected"] = False
-
-        detected_faces = []
-        for (top, right, bottom, left) in face_locations:
-            x, y = left, top
-            w, h = right - left, bottom - top
+        self._update_enroll_manifest(image_path, digest)
+        print(f"Кодування створено для {image_path}")
+        with self.faces_lock:
+            face = job["face"]
+            if face is None:
+                face = self.registry.add(self._new_face_entry(job["name"], image_path, job["encoding_path"], encoding))
+                self.saved_model.add_face(face)
+            else:
+                face.encoding = encoding
+                face.encoding_path = job["encoding_path"]
+                self.saved_model.face_changed(face.id, image_changed=True)
+            self.gallery.add(face, encoding)
+        self._persist_face(face, encoding)
+
+    def on_enrollment_finished(self):
+        self.enroll_progress.hide()
+        self._save_enroll_manifest()
+        self.update_ann_index()
+        if self.gallery_file_stale:
+            self.face_writer.compact()
+
+    def _manifest_key(self, image_path):
+        return os.path.relpath(image_path, self.FACE_DATA_FOLDER).replace(os.sep, "/")
+
+    def _is_enrollment_current(self, image_path):
+        """
+        Чи збігаються розмір і час зміни зображення з маніфестом.
+        None – зображення ще немає в маніфесті.
+        """
+        entry = self.enroll_manifest.get(self._manifest_key(image_path))
+        if entry is None:
+            return None
+        stat = os.stat(image_path)
+        return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+    def _update_enroll_manifest(self, image_path, digest):
+        stat = os.stat(image_path)
+        self.enroll_manifest[self._manifest_key(image_path)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": digest
+        }
+
+    def _load_enroll_manifest(self):
+        if not os.path.exists(self.ENROLL_MANIFEST_FILE):
+            return {}
+        try:
+            with open(self.ENROLL_MANIFEST_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print("Помилка завантаження маніфесту:", e)
+            return {}
 
-            encodings = face_recognition.face_encodings(rgb_frame, [(top, right, bottom, left)])
-            if not encodings:
-                continue
-            encoding = encodings[0]
-
-            landmarks = face_recognition.face_landmarks(rgb_frame, face_locations=[(top, right, bottom, left)])
-            landmarks = landmarks[0] if landmarks else {}
-
-            matched = False
-            for face in self.saved_faces:
-                if face["encoding"] is None:
-                    if os.path.exists(face.get("encoding_path", "")):
-                        face["encoding"] = np.load(face["encoding_path"])
-                if face["encoding"] is not None:
-                    match = face_recognition.compare_faces([face["encoding"]], encoding, tolerance=0.5)
-                    if match[0]:
-                        label = face["name"]
-                        description = face["description"]
-                        face["bbox"] = (x, y, w, h)
-                        detected_faces.append({
-                            "bbox": (x, y, w, h),
-                            "label": label,
-                            "description": description,
-                            "landmarks": landmarks
-                        })
-                        matched = True
-                        break
-            if matched:
-                continue
+    def _save_enroll_manifest(self):
+        # Пишемо копію: GUI-потік продовжує змінювати маніфест, поки запис чекає в черзі
+        self.face_writer.submit(write_json_atomic, self.ENROLL_MANIFEST_FILE, dict(self.enroll_manifest))
 
-            for face in self.unknown_faces:
-                match = face_recognition.compare_faces([face["encoding"]], encoding, tolerance=0.5)
-                if match[0]:
-                    face["bbox"] = (x, y, w, h)
-                    crop = rgb_frame[y:y+h, x:x+w]
-                    face["pixmap"] = self.numpy2pixmap(crop)
-                    face["detected"] = True
+    def identify_faces(self, rgb_frame, tracks, with_landmarks=False, camera_index=0):
+        """
+        Визначає особу кожного треку та повертає список облич для відображення.
+        Кодування обчислюються лише для треків без особи (нові або ті, чию особу видалили)
+        та для треків, яким TrackEncodingCache призначив перевірку; решта треків повторно
+        використовує знайдену раніше особу. Перед кодуванням обличчя проходять FaceQualityGate:
+        непридатні (замалі, розмиті, темні, у профіль) до енкодера не потрапляють.
+        Викликається з потоку RecognitionWorker камери camera_index; галерея та невідомі
+        обличчя спільні для всіх камер.
+        """
+        now = time.monotonic()
+        with self.faces_lock:
+            for track in tracks:
+                if not self._is_face_current(track.face):
+                    track.encoding = None
+            pending = [track for track in tracks if self.track_cache.needs_encoding(track, now)]
+        if pending:
+            # Перевірка якості перед енкодером; форми облич потім ідуть в енкодер без перерахунку
+            started = time.perf_counter()
+            shapes = face_shapes(rgb_frame, [track.location for track in pending])
+            accepted = []
+            accepted_shapes = []
+            for track, shape in zip(pending, shapes):
+                track.quality_issue = self.quality_gate.check(rgb_frame, track.location, shape)
+                if track.quality_issue is None:
+                    accepted.append(track)
+                    accepted_shapes.append(shape)
+                else:
+                    self.metrics.increment(f"faces_skipped_{track.quality_issue}", 1, camera_index)
+            self.metrics.observe("quality", time.perf_counter() - started, camera_index)
+            pending = accepted
+        if pending:
+            started = time.perf_counter()
+            encodings, _ = analyze_faces(rgb_frame, [track.location for track in pending], shapes=accepted_shapes)
+            self.metrics.observe("encode", time.perf_counter() - started, camera_index)
+            self.metrics.increment("faces_encoded", len(pending), camera_index)
+        else:
+            encodings = []
+        for track, encoding in zip(pending, encodings):
+            self.track_cache.store(track, encoding, now)
+        if with_landmarks:
+            landmarks = [
+                extract_landmarks(rgb_frame, dlib.rectangle(left, top, right, bottom))
+                for (top, right, bottom, left) in (track.location for track in tracks)
+            ]
+        else:
+            landmarks = [{} for _ in tracks]
+
+        with self.faces_lock:
+            if pending:
+                started = time.perf_counter()
+                self._assign_faces(pending, encodings, now)
+                self.metrics.observe("match", time.perf_counter() - started, camera_index)
+
+            encoded_tracks = {id(track) for track in pending}
+            detected_faces = []
+            for track, face_landmarks in zip(tracks, landmarks):
+                face = track.face
+                top, right, bottom, left = track.location
+                x, y, w, h = left, top, right - left, bottom - top
+                if face is None:
+                    # Обличчя ще жодного разу не пройшло перевірку якості – рамка без особи
                     detected_faces.append({
                         "bbox": (x, y, w, h),
-                        "label": face["name"],
-                        "description": face["description"],
-                        "landmarks": landmarks
+                        "label": f"? ({track.quality_issue})" if track.quality_issue else "?",
+                        "description": "",
+                        "landmarks": face_landmarks,
+                        "track_id": track.track_id,
+                        "face_id": None
                     })
-                    matched = True
-                    break
-
-            if not matched:
-                face_id = self.next_unknown_id
-                self.next_unknown_id += 1
-                name = f"Unknown_{face_id}"
-                crop = rgb_frame[y:y+h, x:x+w]
-                face_entry = {
-                    "id": face_id,
-                    "encoding": encoding,
-                            "bbox": (x, y, w, h),
-            "pixmap": self.numpy2pixmap(crop),
-                    "name": name,
-                    "description": "",
-                    "detected": True
-                }
-                self.unknown_faces.append(face_entry)
+                    continue
+                face.bbox = (x, y, w, h)
+                if self.gallery.get(face.id) is not face:
+                    self.unknown_faces.touch(face, now)
+                    # Фрагмент кадру для діалогу захоплення оновлюється разом з кодуванням
+                    if face.crop is None or id(track) in encoded_tracks:
+                        face.crop = rgb_frame[y:y+h, x:x+w].copy()
                 detected_faces.append({
                     "bbox": (x, y, w, h),
-                    "label": name,
-                    "description": "",
-                    "landmarks": landmarks
+                    "label": face.name,
+                    "description": face.description,
+                    "landmarks": face_landmarks,
+                    "track_id": track.track_id,
+                    "face_id": face.id
                 })
 
-        removed_faces = [face for face in self.unknown_faces if not face.get("detected", False)]
-        for face in removed_faces:
-            self.unknown_faces.remove(face)
-
-        h_frame, w_frame, ch = rgb_frame.shape
-        bytes_per_line = ch * w_frame
-        qt_image = QImage(rgb_frame.data, w_frame, h_frame, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qt_image)
-        container_size = self.video_label.parent().size()
-        scaled_pixmap = pixmap.scaled(container_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-
-        painter = QPainter(scaled_pixmap)
-        scale_x = scaled_pixmap.width() / w_frame
-        scale_y = scaled_pixmap.height() / h_frame
-
-        for face in detected_faces:
-            x, y, fw, fh = face["bbox"]
-            rx = int(x * scale_x)
-            ry = int(y * scale_y)
-            rfw = int(fw * scale_x)
-            rfh = int(fh * scale_y)
-
-            if self.draw_landmarks:
-                pen = QPen(QColor(0, 255, 0), 2)
-                painter.setPen(pen)
-                landmarks = face.get("landmarks", {})
-                for feature, points in landmarks.items():
-                    for point in points:
-                        px = int(point[0] * scale_x)
-                        py = int(point[1] * scale_y)
-                        painter.drawEllipse(px - 2, py - 2, 4, 4)
-            else:
-                pen = QPen(QColor(0, 255, 0))
-                pen.setWidth(2)
-                painter.setPen(pen)
-                painter.drawRect(rx, ry, rfw, rfh)
-
-            # Зовнішні відступи (margin) для різних сторін:
-            external_offset_left = 8            # відступ від лівої межі обличчя до текстового блоку
-            external_offset_name = 8            # відступ від верхньої межі обличчя до блоку з ім'ям
-            external_offset_description = 8     # відступ від нижньої межі обличчя до блоку з описом
-
-            # Внутрішній відступ (padding) всередині блоку з текстом:
-            internal_padding = 4
-
-            # Змінна для регулювання округлення кутів:
-            border_radius = 10
-
-            fm = painter.fontMetrics()
-
-            # Рендеринг заголовка (ім'я) над обличчям:
-            label = face["label"]
-            label_width = fm.horizontalAdvance(label)
-            label_height = fm.height()
-
-            label_bg_width = label_width + 2 * internal_padding
-            label_bg_height = label_height + 2 * internal_padding
-            # Нижня межа блоку з ім'ям буде external_offset_name пікселів вище верхньої межі обличчя
-            label_bg_bottom = ry - external_offset_name
-            label_bg_top = max(label_bg_bottom - label_bg_height, 0)
-            label_bg_x = rx + external_offset_left
-
-            label_background_rect = QRect(label_bg_x, label_bg_top, label_bg_width, label_bg_height)
-
-            # Вмикаємо згладжування для кращої якості округлених кутів
-            painter.setRenderHint(QPainter.Antialiasing)
-            painter.setPen(Qt.NoPen)
-            painter.setBrush(QColor(0, 255, 0))
-            painter.drawRoundedRect(label_background_rect, border_radius, border_radius)
-            painter.setPen(Qt.black)
-
-            label_text_rect = QRect(
-                label_background_rect.left() + internal_padding,
-                label_background_rect.top() + internal_padding,
-                label_width,
-                label_height
-            )
-            painter.drawText(label_text_rect, Qt.AlignLeft | Qt.AlignVCenter, label)
+            # Невідоме обличчя живе ttl секунд після того, як його востаннє бачила будь-яка камера
+            self.unknown_faces.expire(now)
+        return detected_faces
 
-            # Рендеринг опису під обличчям:
-            if face["description"]:
-                description_lines = face["description"].splitlines()
-                max_line_width = max(fm.horizontalAdvance(line) for line in description_lines)
-                total_text_height = len(description_lines) * label_height
-
-                desc_bg_x = rx + external_offset_left
-                desc_bg_y = ry + rfh + external_offset_description
-                desc_bg_width = max_line_width + 2 * internal_padding
-                desc_bg_height = total_text_height + 2 * internal_padding
-
-                desc_background_rect = QRect(desc_bg_x, desc_bg_y, desc_bg_width, desc_bg_height)
-                
-                painter.setPen(Qt.NoPen)
-                painter.setBrush(QColor(0, 255, 0))
-                painter.drawRoundedRect(desc_background_rect, border_radius, border_radius)
-                painter.setPen(Qt.black)
-
-                for idx, line in enumerate(description_lines):
-                    line_y = desc_background_rect.top() + internal_padding + idx * label_height
-                    line_rect = QRect(
-                        desc_background_rect.left() + internal_padding,
-                        line_y,
-                        max_line_width,
-                        label_height
-                    )
-                    painter.drawText(line_rect, Qt.AlignLeft | Qt.AlignVCenter, line)
+    def _is_face_current(self, face):
+        """Чи є обличчя досі збереженим або відстежуваним невідомим (а не видаленим)."""
+        if face is None:
+            return False
+        if self.gallery.get(face.id) is face:
+            return True
+        return self.unknown_faces.is_current(face)
+
+    def _assign_faces(self, tracks, encodings, now):
+        """Шукає особу для треків з обчисленими кодуваннями: спершу в галереї, потім серед невідомих."""
+        matched_faces, distances = self.gallery.match(encodings)
+        for track, encoding, saved_face, distance in zip(tracks, encodings, matched_faces, distances):
+            if saved_face is not None and distance <= MATCH_TOLERANCE:
+                track.face = saved_face
+                continue
 
+            track.face = self.unknown_faces.match(encoding)
+            if track.face is None:
+                track.face = self.unknown_faces.add(encoding, now)
 
+    def on_load_level_changed(self, camera_index, level):
+        """Слот RecognitionPipeline.load_level_changed."""
+        print(f"Камера {camera_index}: навантаження – {self.pipelines[camera_index].load_shedder}")
+        self.update_load_label()
 
-        painter.end()
-        self.video_label.setPixmap(scaled_pixmap)
+    def update_load_label(self):
+        """Показує в рядку стану, чи знижено якість обробки якоїсь камери."""
+        if not self.latency_budget:
+            self.load_label.setText("")
+            return
+        reduced = [pipeline for pipeline in self.pipelines if pipeline.load_shedder.level]
+        if not reduced:
+            self.load_label.setText("Quality: full")
+        elif len(self.pipelines) == 1:
+            self.load_label.setText(f"Quality: reduced ({reduced[0].load_shedder})")
+        else:
+            self.load_label.setText("Quality: reduced (" + ", ".join(
+                f"cam {pipeline.camera_index} level {pipeline.load_shedder.level}" for pipeline in reduced) + ")")
 
+    def render_frame(self, camera_index, display_frame, detected_faces, captured_at=None):
+        """
+        Передає кадр камери camera_index з обличчями у її VideoWidget. Слот сигналу RecognitionPipeline.frame_ready.
+        Масштабування та малювання підписів відбувається в paintEvent віджета.
+        """
+        if captured_at is not None:
+            # Від захоплення кадру камерою до передачі у віджет (без часу самого малювання)
+            self.metrics.observe("display", time.perf_counter() - captured_at, camera_index)
+        if not self.first_frame_shown:
+            self.first_frame_shown = True
+            self.startup.phase("first frame")
+        video_widget = self.video_widgets[camera_index]
+        pipeline = self.pipelines[camera_index]
+        video_widget.draw_landmarks = pipeline.landmarks_enabled()
+        video_widget.hud_lines = self.hud_lines(camera_index) if self.show_hud else None
+        video_widget.set_frame(display_frame, detected_faces)
+        caption = f"Cam {camera_index} – {pipeline.fps:.1f} fps"
+        if pipeline.load_shedder.level:
+            caption += f", load level {pipeline.load_shedder.level}"
+        self.camera_captions[camera_index].setText(caption)
+
+        # LIST CURRENT об'єднує обличчя всіх камер
+        self.camera_faces[camera_index] = [face["label"] for face in detected_faces]
+        multi_camera = len(self.pipelines) > 1
         self.current_list.clear()
-        for face in detected_faces:
-            self.current_list.addItem(face["label"])
+        for index in sorted(self.camera_faces):
+            for label in self.camera_faces[index]:
+                self.current_list.addItem(f"{label} (cam {index})" if multi_camera else label)
+
+    def update_metric_gauges(self):
+        """Оновлює метрики, які зберігаються поза PipelineMetrics: fps, відкинуті кадри, розмір галереї, кеш."""
+        for pipeline in self.pipelines:
+            self.metrics.set_gauge("fps", round(pipeline.fps, 2), pipeline.camera_index)
+            self.metrics.set_counter("frames_dropped", pipeline.total_dropped_frames(), pipeline.camera_index)
+            self.metrics.set_counter("frames_overwritten", pipeline.capture.overwritten, pipeline.camera_index)
+            self.metrics.set_gauge("load_level", pipeline.load_shedder.level, pipeline.camera_index)
+        with self.faces_lock:
+            self.metrics.set_gauge("gallery_faces", len(self.gallery))
+            self.metrics.set_gauge("unknown_faces", len(self.unknown_faces))
+            self.metrics.set_counter("unknown_faces_evicted", self.unknown_faces.evicted)
+        self.metrics.set_counter("track_cache_hits", self.track_cache.hits)
+        self.metrics.set_counter("track_cache_misses", self.track_cache.misses)
+
+    def export_metrics(self):
+        """Слот таймера: записує метрики у metrics_file."""
+        self.update_metric_gauges()
+        try:
+            self.metrics.write(self.metrics_file)
+        except OSError as e:
+            print(f"Не вдалося записати метрики в {self.metrics_file}: {e}")
+
+    def hud_lines(self, camera_index):
+        """Рядки HUD: fps, відкинуті кадри, формат камери, рівень навантаження, розмір галереї та p50/p99 етапів."""
+        pipeline = self.pipelines[camera_index]
+        lines = [
+            f"Cam {camera_index}: {pipeline.fps:.1f} fps, dropped {pipeline.total_dropped_frames()}",
+            f"Format: {pipeline.capture}",
+            f"Load: {pipeline.load_shedder}",
+            f"Gallery: {len(self.gallery)} faces, unknown: {len(self.unknown_faces)}",
+        ]
+        skipped = {reason: self.metrics.counter(f"faces_skipped_{reason}", camera_index)
+                   for reason in FaceQualityGate.REASONS}
+        if any(skipped.values()):
+            lines.append("Skipped: " + ", ".join(f"{reason} {count}" for reason, count in skipped.items() if count))
+        for stage in ("capture", "detect", "track", "quality", "encode", "match", "render", "end_to_end",
+                      "display"):
+            quantiles = self.metrics.stage_quantiles(stage, camera_index)
+            if quantiles is not None:
+                lines.append(f"{stage:<10} p50 {quantiles[0] * 1000:7.1f} ms  p99 {quantiles[2] * 1000:7.1f} ms")
+        return lines
 
     def numpy2pixmap(self, image_np):
         if image_np is None or image_np.size == 0:
@@ -837,48 +4363,46 @@ class FaceRecognitionApp(QMainWindow):
         return QPixmap.fromImage(qt_image)
 
     def capture_frames(self):
-        unknowns = self.unknown_faces.copy()
+        with self.faces_lock:
+            unknowns = list(self.unknown_faces)
         for face in unknowns:
+            face.pixmap = self.numpy2pixmap(face.crop)
             dlg = FaceDialog(
-            face_pixmap=face["pixmap"],
-            init_name=face["name"],
-            init_description=face["description"],
-            init_encoding=face.get("encoding", None),
+            face_pixmap=face.pixmap,
+            init_name=face.name,
+            init_description=face.description,
+            init_encoding=face.encoding,
             mode="capture",
             parent=self
             )
             result = dlg.exec()
-            if result == QDialog.Accepted:
-                new_name, description, new_pixmap, new_encoding = dlg.getData()
-                old_name = face["name"]
+            new_name, description, new_pixmap, new_encoding = dlg.getData()
+            if result == QDialog.Accepted and self._name_is_free(new_name or face.name):
+                old_name = face.name
                 if new_name:
-                    face["name"] = new_name
-                face["description"] = description
+                    face.name = new_name
+                face.description = description
                 if new_pixmap is not None and not new_pixmap.isNull():
-                    face["pixmap"] = new_pixmap
+                    face.pixmap = new_pixmap
                 if new_encoding is not None:
-                    face["encoding"] = new_encoding
-
-                # Створюємо (або перейменовуємо) теку для обличчя
-                face_folder = os.path.join(self.FACE_DATA_FOLDER, face["name"])
-                if not os.path.exists(face_folder):
-                    old_face_folder = os.path.join(self.FACE_DATA_FOLDER, old_name)
-                    if os.path.exists(old_face_folder):
-                        os.rename(old_face_folder, face_folder)
-                    else:
-                        os.makedirs(face_folder)
-                image_save_path = os.path.join(face_folder, f"{face['name']}.jpg")
-                encoding_save_path = os.path.join(face_folder, f"{face['name']}.npy")
-
-                face["pixmap"].save(image_save_path, "JPG")
-                np.save(encoding_save_path, face["encoding"])
-                face["image_path"] = image_save_path
-                face["encoding_path"] = encoding_save_path
-
-                self.saved_faces.append(face)
-                self.unknown_faces = [f for f in self.unknown_faces if f["id"] != face["id"]]
-                self._remove_item_from_list(self.current_list, face["name"])
-                self.saved_list.addItem(face["name"])
+                    face.encoding = new_encoding
+
+                image = face.pixmap.toImage()
+
+                with self.faces_lock:
+                    unknown_id = face.id
+                    # id невідомих облич мають власну нумерацію, тому видаємо id зі збережених
+                    face.id = self.registry.allocate_id()
+                    face.crop = None
+                    face.pixmap = None
+                    self.registry.add(face)
+                    self.gallery.add(face, face.encoding)
+                    self.unknown_faces.remove(unknown_id)
+
+                # Створюємо (або перейменовуємо) теку для обличчя та записуємо файли у фоні
+                self._persist_face(face, face.encoding, image, old_name)
+                self._remove_item_from_list(self.current_list, face.name)
+                self.saved_model.add_face(face)
             loop = QEventLoop()
             QTimer.singleShot(100, loop.quit)
             loop.exec()
@@ -891,101 +4415,253 @@ class FaceRecognitionApp(QMainWindow):
                 break
 
     def edit_face(self):
-        selected_items = self.saved_list.selectedItems()
-        if not selected_items:
-            return
-        item = selected_items[0]
-        face = next((f for f in self.saved_faces if f["name"] == item.text()), None)
+        face = self.selected_saved_face()
         if face is None:
             return
 
-        if face["pixmap"] is None and os.path.exists(face["image_path"]):
-            face["pixmap"] = QPixmap(face["image_path"])
+        if face.encoding is None:
+            face.encoding = self.gallery.encoding(face.id)
 
+        face_pixmap = self._load_face_pixmap(face)
         dlg = FaceDialog(
-            face_pixmap=face["pixmap"] if face["pixmap"] is not None else QPixmap(),
-            init_name=face["name"],
-            init_description=face["description"],
-            init_encoding=face.get("encoding", None),
+            face_pixmap=face_pixmap,
+            init_name=face.name,
+            init_description=face.description,
+            init_encoding=face.encoding,
             mode="edit",
             parent=self
         )
         result = dlg.exec()
         if result == QDialog.Accepted:
             new_name, description, new_pixmap, new_encoding = dlg.getData()
-            old_name = face["name"]
+            old_name = face.name
+            if new_name and not self._name_is_free(new_name, face):
+                return
             if new_name:
-                face["name"] = new_name
-            face["description"] = description
+                with self.faces_lock:
+                    self.registry.rename(face, new_name)
+            face.description = description
             if new_pixmap is not None and not new_pixmap.isNull():
-                face["pixmap"] = new_pixmap
+                face_pixmap = new_pixmap
             if new_encoding is not None:
-                face["encoding"] = new_encoding
-
-            old_face_folder = os.path.join(self.FACE_DATA_FOLDER, old_name)
-            new_face_folder = os.path.join(self.FACE_DATA_FOLDER, face["name"])
-            if old_face_folder != new_face_folder and os.path.exists(old_face_folder):
-                os.rename(old_face_folder, new_face_folder)
-            else:
-                if not os.path.exists(new_face_folder):
-                    os.makedirs(new_face_folder)
-            image_save_path = os.path.join(new_face_folder, f"{face['name']}.jpg")
-            encoding_save_path = os.path.join(new_face_folder, f"{face['name']}.npy")
-            face["pixmap"].save(image_save_path, "JPG")
-            np.save(encoding_save_path, face["encoding"])
-            face["image_path"] = image_save_path
-            face["encoding_path"] = encoding_save_path
+                face.encoding = new_encoding
 
-            item.setText(face["name"])
+            self._persist_face(face, face.encoding, face_pixmap.toImage(), old_name)
+            with self.faces_lock:
+                self.gallery.add(face, face.encoding)
+            self.overlay_sprites.invalidate(face.id)
+            self.saved_model.face_changed(face.id, image_changed=True)
 
     def delete_face(self):
-        selected_items = self.saved_list.selectedItems()
-        if not selected_items:
-            return
-        item = selected_items[0]
-        face_to_delete = next((face for face in self.saved_faces if face["name"] == item.text()), None)
+        face_to_delete = self.selected_saved_face()
         if face_to_delete is None:
             return
 
-        face_folder = os.path.join(self.FACE_DATA_FOLDER, face_to_delete["name"])
-        if os.path.exists(face_folder):
-            try:
-                shutil.rmtree(face_folder)
-                print(f"Видалено папку обличчя: {face_folder}")
-            except Exception as e:
-                print(f"Не вдалося видалити папку {face_folder}: {e}")
-
-        self.saved_faces = [face for face in self.saved_faces if face["name"] != item.text()]
-        self.saved_list.takeItem(self.saved_list.row(item))
+        with self.faces_lock:
+            self.registry.remove(face_to_delete.id)
+            self.gallery.remove(face_to_delete.id)
+        self._forget_face(face_to_delete)
+        self.overlay_sprites.invalidate(face_to_delete.id)
+        self.saved_model.remove_face(face_to_delete.id)
 
     def closeEvent(self, event):
-        self.capture.release()
-        self.save_saved_faces()
+        if self.startup_worker.isRunning():
+            # Вікно закрили ще під час запуску: конвеєри вже не потрібні, лише звільняємо камери
+            self.startup_worker.finished.disconnect(self.on_startup_finished)
+            self.startup_worker.wait()
+            self.captures = self.startup_worker.results.get("cameras") or []
+        for pipeline in self.pipelines:
+            pipeline.stop()
+        self.detector_pool.stop()
+        self.saved_model.stop()
+        if self.enrollment_worker is not None and self.enrollment_worker.isRunning():
+            self.enrollment_worker.requestInterruption()
+            self.enrollment_worker.wait()
+            self._save_enroll_manifest()
+        print("Кеш кодувань треків:", self.track_cache)
+        print("Перевірка якості облич:", self.quality_gate)
+        if self.metrics_file:
+            self.metrics_timer.stop()
+            self.export_metrics()
+        for pipeline in self.pipelines:
+            print(f"Камера {pipeline.camera_index}: відкинуто кадрів {pipeline.total_dropped_frames()}, "
+                  f"змін рівня навантаження {pipeline.load_shedder.changes}")
+        for capture in self.captures:
+            capture.release()
+        # Журнал уже містить усі зміни, тож лише дочікуємося черги запису (без повного знімка)
+        if not self.face_writer.isRunning():
+            self.face_writer.start()
+        self.face_writer.stop()
         event.accept()
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_V:
             self.draw_landmarks = not self.draw_landmarks
+            for pipeline in self.pipelines:
+                pipeline.draw_landmarks = self.draw_landmarks
             print("Режим landmarks:", self.draw_landmarks)
+        elif event.key() == Qt.Key_H:
+            self.show_hud = not self.show_hud
         super().keyPressEvent(event)
 
+def parse_fourcc(text):
+    text = text.strip().upper()
+    if len(text) != 4:
+        raise argparse.ArgumentTypeError("FOURCC must be 4 characters, e.g. MJPG")
+    return text
+
+
+def parse_frame_size(text):
+    try:
+        width, height = (int(side) for side in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("frame size must look like 1280x720")
+    return width, height
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="PyFaceID – facial recognition system")
+    parser.add_argument("--metrics-file", default=None,
+                        help="periodically write pipeline metrics to this file (.prom textfile for "
+                             "Prometheus node_exporter, or .json)")
+    parser.add_argument("--scaling", choices=["fast", "smooth"], default="fast",
+                        help="video scaling: nearest neighbour (fast) or bilinear (smooth)")
+    parser.add_argument("--metrics-interval", type=float, default=15.0, help="metrics write interval in seconds")
+    parser.add_argument("--min-face-size", type=int, default=40,
+                        help="skip encoding faces smaller than this many pixels (0 disables)")
+    parser.add_argument("--min-sharpness", type=float, default=25.0,
+                        help="skip encoding blurry faces: minimum Laplacian variance of the face crop (0 disables)")
+    parser.add_argument("--min-brightness", type=float, default=40,
+                        help="skip encoding too dark faces: minimum mean brightness of the face crop, 0-255 (0 disables)")
+    parser.add_argument("--max-brightness", type=float, default=220,
+                        help="skip encoding overexposed faces: maximum mean brightness of the face crop, 0-255 "
+                             "(0 disables)")
+    parser.add_argument("--max-yaw", type=float, default=0.45,
+                        help="skip encoding strongly turned faces: maximum nose offset from the eye midpoint, "
+                             "in eye distances (0 disables)")
+    parser.add_argument("--camera-format", type=parse_fourcc, default=None,
+                        help="request a camera pixel format (FOURCC), e.g. MJPG or YUYV")
+    parser.add_argument("--camera-size", type=parse_frame_size, default=None,
+                        help="request a camera frame size, e.g. 1280x720")
+    parser.add_argument("--camera-fps", type=float, default=None, help="request a camera frame rate")
+    parser.add_argument("--camera-buffer", type=int, default=1,
+                        help="driver buffer size in frames (0 keeps the driver default)")
+    parser.add_argument("--latency-budget", type=float, default=0.25,
+                        help="target capture-to-result latency in seconds; above it detection runs less often, "
+                             "at lower resolution and without landmarks until headroom returns (0 disables)")
+    parser.add_argument("--sqlite", action="store_true",
+                        help="keep the gallery in a single SQLite file (face_data/faces.db); existing data is "
+                             "imported on first use and the database is used from then on")
+    subparsers = parser.add_subparsers(dest="command")
+
+    bench_ann = subparsers.add_parser("bench-ann", help="benchmark approximate gallery search against exact search")
+    bench_ann.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 300000],
+                           help="gallery sizes to test")
+    bench_ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16],
+                           help="numbers of probed clusters to test")
+    bench_ann.add_argument("--queries", type=int, default=500, help="number of queries per gallery size")
+
+    bench = subparsers.add_parser("bench", help="benchmark each recognition pipeline stage (JSON output)")
+    bench.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    bench.add_argument("--baseline", default=None, help="previous results file to compare against")
+    bench.add_argument("--resolutions", nargs="+", default=["640x480", "1280x720", "1920x1080"],
+                       help="synthetic frame sizes (WIDTHxHEIGHT)")
+    bench.add_argument("--faces", type=int, nargs="+", default=[0, 1, 4], help="faces per synthetic frame")
+    bench.add_argument("--gallery-sizes", type=int, nargs="+", default=[100, 10000, 100000],
+                       help="gallery sizes for matching")
+    bench.add_argument("--models", choices=["hog", "cnn"], nargs="+", default=["hog"],
+                       help="face detection models (cnn is very slow without CUDA)")
+    bench.add_argument("--repeat", type=int, default=20, help="minimum runs per stage")
+    bench.add_argument("--min-time", type=float, default=0.5, help="minimum seconds per stage")
+
+    recognize = subparsers.add_parser("recognize", help="recognize faces in image files without GUI (JSONL output)")
+    recognize.add_argument("paths", nargs="+", help="image files, directories or glob patterns")
+    recognize.add_argument("-o", "--output", default="-", help="JSONL output file (default: stdout)")
+    recognize.add_argument("--face-data", default=FACE_DATA_FOLDER, help="face data folder")
+    recognize.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    recognize.add_argument("--model", choices=["hog", "cnn"], default="hog", help="face detection model")
+    recognize.add_argument("--detection", type=DetectionResolution.parse, default=None,
+                           help="detection width in px or scale (default: auto)")
+    recognize.add_argument("--tolerance", type=float, default=MATCH_TOLERANCE, help="match tolerance")
+
+    video = subparsers.add_parser("video", help="recognize faces in a recorded video file without GUI")
+    video.add_argument("path", help="video file")
+    video.add_argument("-o", "--output", default="-", help="JSONL output file (default: stdout)")
+    video.add_argument("--timeline", choices=["frames", "tracks"], default="frames",
+                       help="one line per sampled frame or per track")
+    video.add_argument("--stride", type=int, default=5, help="process every N-th frame")
+    video.add_argument("--shards", type=int, default=None, help="number of frame ranges (default: 4 per worker)")
+    video.add_argument("--face-data", default=FACE_DATA_FOLDER, help="face data folder")
+    video.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    video.add_argument("--model", choices=["hog", "cnn"], default="hog", help="face detection model")
+    video.add_argument("--detection", type=DetectionResolution.parse, default=None,
+                       help="detection width in px or scale (default: auto)")
+    video.add_argument("--tolerance", type=float, default=MATCH_TOLERANCE, help="match tolerance")
+
+    # Невідомі аргументи (наприклад, -platform) віддаємо Qt
+    return parser.parse_known_args()
+
+
 if __name__ == '__main__':
-    
-    app = QApplication(sys.argv)
+    # Потрібно для пулу процесів у зібраному PyInstaller-застосунку
+    multiprocessing.freeze_support()
+
+    args, qt_args = parse_args()
+    if args.command == "bench-ann":
+        benchmark_ann(args.sizes, args.nprobe, args.queries)
+        sys.exit(0)
+    if args.command == "bench":
+        # QPixmap та QPainter потребують QApplication; без дисплея запускайте з -platform offscreen
+        app = QApplication(sys.argv[:1] + qt_args)
+        resolutions = [tuple(int(value) for value in size.lower().split("x")) for size in args.resolutions]
+        report = run_stage_benchmarks(args.output, resolutions, args.faces, args.gallery_sizes, args.models,
+                                      args.repeat, args.min_time)
+        if args.baseline:
+            compare_stage_benchmarks(args.baseline, report)
+        sys.exit(0)
+    if args.command == "recognize":
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        with output:
+            sys.exit(run_batch_recognition(args.paths, output, args.face_data, args.workers, args.model,
+                                           args.detection, args.tolerance))
+    if args.command == "video":
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        with output:
+            sys.exit(run_video_recognition(args.path, output, args.face_data, args.workers, max(args.stride, 1),
+                                           args.shards, args.timeline, args.model, args.detection,
+                                           args.tolerance))
+
+    startup = StartupTimer()
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setWindowIcon(QIcon("assets/icon.svg"))
+    startup.phase("Qt")
+    # Моделі dlib вантажаться, поки користувач вибирає камеру
+    start_face_model_warmup()
 
     # Показуємо вікно вибору камери перед запуском програми
     dialog = VideoSourceDialog()
     if dialog.exec() == QDialog.Accepted:
-        source = dialog.get_video_source()
-        if source is None:
-            QMessageBox.critical(None, "Error", "Invalid video source. Please enter a number.")
+        sources = dialog.get_video_sources()
+        if not sources:
+            QMessageBox.critical(None, "Error", "Invalid video source. Please enter a number or comma-separated numbers.")
+            sys.exit(1)
+        try:
+            detection_resolution = dialog.get_detection_resolution()
+        except ValueError:
+            QMessageBox.critical(None, "Error", "Invalid detection width or scale.")
             sys.exit(1)
     else:
         sys.exit(0)
-
-    video_capture_source = cv2.VideoCapture(source)
-
-    window = FaceRecognitionApp()
+    startup.phase("video source dialog")
+
+    # Камери відкриваються у фоні разом з іншими етапами запуску (StartupWorker)
+    window = FaceRecognitionApp(sources, detection_resolution, args.metrics_file, args.metrics_interval,
+                                smooth_scaling=args.scaling == "smooth", use_sqlite=args.sqlite, startup=startup,
+                                quality_gate=FaceQualityGate(args.min_face_size, args.min_sharpness,
+                                                             args.min_brightness, args.max_brightness, args.max_yaw),
+                                camera_options={"fourcc": args.camera_format, "size": args.camera_size,
+                                                "fps": args.camera_fps, "buffer_size": args.camera_buffer},
+                                latency_budget=args.latency_budget)
+    startup.phase("main window")
     sys.exit(app.exec())
 
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import FaceGallery, FaceRecord
+
+
+class FaceGalleryEmptySnapshotTest(unittest.TestCase):
+    """Галерея, відновлена з порожнього знімка (0 рядків матриці), має рости при add."""
+
+    def encoding(self, seed):
+        return np.random.default_rng(seed).normal(size=FaceGallery.ENCODING_SIZE).astype(np.float32)
+
+    def test_add_after_empty_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            matrix_path = os.path.join(folder, "gallery.npy")
+            index_path = os.path.join(folder, "gallery_index.json")
+            FaceGallery().save(matrix_path, index_path)
+            gallery = FaceGallery()
+            self.assertTrue(gallery.load(matrix_path, index_path, {}))
+            self.assertEqual(len(gallery), 0)
+
+            face = FaceRecord(1, "alice")
+            gallery.add(face, self.encoding(1))
+            self.assertEqual(len(gallery), 1)
+            faces, distances = gallery.match([self.encoding(1)])
+            self.assertIs(faces[0], face)
+            self.assertLess(float(distances[0]), 0.05)
+
+    def test_add_after_empty_assign(self):
+        gallery = FaceGallery()
+        gallery.assign([], np.empty((0, FaceGallery.ENCODING_SIZE), dtype=np.float32))
+        for face_id in range(1, 100):
+            gallery.add(FaceRecord(face_id, f"face{face_id}"), self.encoding(face_id))
+        self.assertEqual(len(gallery), 99)
+
+
+if __name__ == "__main__":
+    unittest.main()